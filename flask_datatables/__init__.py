@@ -1,12 +1,32 @@
 from __future__ import print_function
+from array import array
 from collections import namedtuple
-from sqlalchemy import and_, or_, desc, asc, alias
-from sqlalchemy.orm import relation, backref, synonym, outerjoin, join, eagerload, relationship, validates, aliased
+from contextlib import contextmanager
+from itertools import islice
+from sqlalchemy import and_, or_, desc, asc, alias, bindparam, distinct, false, func, select, types
+from sqlalchemy.orm import relation, backref, synonym, outerjoin, join, eagerload, relationship, validates, aliased, selectinload, class_mapper, object_mapper
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm.attributes import QueryableAttribute
+from sqlalchemy.orm.properties import ColumnProperty
+from sqlalchemy.sql.expression import ColumnElement
 import inspect
+import json
+import time
 from querystring_parser import parser
-from flask import request, current_app
-from flask_datatables import views
-from flask_datatables.views import apihelpers as helpme
+from flask import request, current_app, stream_with_context
+from werkzeug.http import quote_etag
+from flask_datatables.budget import BudgetExceeded, TimeBudget, limited
+from flask_datatables.caching import LRUCache, PrimaryKeyCache, QueryPlanCache, SingleFlight
+from flask_datatables.counting import get_total_counter
+from flask_datatables.export import FORMATS as EXPORT_FORMATS, Exporter, check_format as check_export_format
+from flask_datatables.matching import (DEFAULT_MATCH_MODE, check_match_mode, check_regex, is_regex_error,
+                                       compile_term_patterns, match_predicate, regex_predicate,
+                                       required_indexes, search_params, search_terms,
+                                       term_can_match)
+from flask_datatables.prefetch import Prefetcher
+from flask_datatables.routing import ReplicaRouter
+from flask_datatables.versioning import TableVersions, expression_tables
+from flask_datatables import apihelpers as helpme
 import sys
 
 if sys.version_info.major == 3:
@@ -16,7 +36,13 @@ def log_debug(message):
     if current_app and current_app.debug:
         print(message, file=sys.stderr)
 
-def get_resource(Resource, Table, Session, basepath="/"):
+def get_resource(Resource, Table, Session, basepath="/", plan_cache_size=200,
+                 read_sessions=None, replica_policy="round_robin", staleness=None,
+                 time_budget=None, count_cap=None, total_count="exact", coalesce=False,
+                 match_modes=None, default_match=DEFAULT_MATCH_MODE, smart_search=True,
+                 term_patterns=None, etags=False, prefetch=False, pk_cache_size=0,
+                 columnar=None, facet_limit=20, facet_max_limit=100, facet_cache_size=100, facet_ttl=60,
+                 computed=None, export=None, max_rows=None, max_bytes=None, recorder=None):
     """ Return a flask-restful datatables resource for SQLAlchemy
 
         This function returns a class subclassed from Flask-Restless Resource
@@ -31,6 +57,106 @@ def get_resource(Resource, Table, Session, basepath="/"):
             Table       (class):    SA Table class
             Session     (inst):     SA Session instance
             basepath    (str):      Base path to put endpoint
+            plan_cache_size (int):  Number of draw shapes (joins, search,
+                                    ordering) to keep baked queries for,
+                                    0 disables; hit rate is available as
+                                    resource.plan_cache.stats.hit_rate
+            read_sessions   (list): Replica Engines or Session factories
+                                    (or a single factory) to run the counts
+                                    and page queries on instead of Session
+            replica_policy  (str):  "round_robin" or "least_loaded"
+            staleness   (float):    Seconds after a write flushed on Session
+                                    during the same request in which draws
+                                    still read from Session, None disables;
+                                    also the most replicas are assumed to
+                                    lag behind, see etags
+            time_budget (float):    Seconds each draw may spend on its page
+                                    and filtered count, see DataTable
+            count_cap   (int):      Most filtered rows to count, see DataTable
+            total_count (str):      How to get recordsTotal: "exact" counts
+                                    the table, "cached" reuses an exact
+                                    count for a minute, "estimated" reads
+                                    planner statistics; or any callable
+                                    (session, Table) -> (count, exact), see
+                                    flask_datatables.counting
+            coalesce    (bool):     Let concurrent requests that only differ
+                                    in draw share one computation (per
+                                    worker process, across threads)
+            match_modes (dict):     Column name -> search match mode, and
+            default_match (str):    the mode of the other columns, see
+                                    DataTable; resource.required_indexes()
+                                    lists the indexes the modes need
+            smart_search (bool):    Split global searches into terms, see
+            term_patterns (dict):   DataTable
+            etags       (bool):     Send an ETag with each draw and answer
+                                    If-None-Match with 304 before querying;
+                                    it changes with the request (except draw
+                                    and _) and with writes committed on Session
+                                    to the tables the draw reads. Pass a
+                                    versioning.TableVersions to share one
+                                    between resources. Clients must send
+                                    If-None-Match themselves, since the draw
+                                    and _ args make every datatables url new.
+                                    Draws read from read_sessions only get
+                                    one (and only use the pk_cache, prefetch
+                                    and facet cache) once staleness seconds
+                                    have passed since the last commit to
+                                    their tables, and never without a
+                                    staleness, as a replica may lag behind
+            prefetch    (bool):     After each draw, compute the next page
+                                    in the background so a click on "next"
+                                    is served from memory; pass a
+                                    prefetch.Prefetcher to set its threads,
+                                    cache size and ttl. Needs read_sessions
+                                    or a scoped_session as Session (and,
+                                    with read_sessions, a staleness, see
+                                    etags). Pages are not served after a
+                                    write committed on Session to the
+                                    tables they read;
+                                    writes made elsewhere go unnoticed until
+                                    the Prefetcher's ttl
+            pk_cache_size (int):    Number of filter + order signatures to
+                                    keep the ordered primary keys of, so
+                                    their later pages are fetched by key;
+                                    writes committed on Session invalidate
+                                    them, see DataTable
+            columnar    (inst):     columnar.ColumnarTable of Table to
+                                    answer draws from memory, watching
+                                    Session for writes; needs numpy
+            facet_limit (int):      Most values returned per facet column
+            facet_max_limit (int):  Most a request's facets_limit may ask for
+            facet_cache_size (int): Number of facet responses to cache, by
+            facet_ttl   (float):    filter, for at most facet_ttl seconds
+                                    (and, with etags or pk_cache_size, only
+                                    until a write to a table they read)
+            computed    (dict):     Column name -> SQL expression computed
+                                    by the database, see DataTable
+            max_rows    (int):      Most rows a draw returns, whatever its
+            max_bytes   (int):      length, and most bytes of JSON they may
+                                    take; see DataTable
+            export      (inst):     export.Exporter to answer requests with
+                                    an export arg, see EXPORTS; True uses
+                                    the default one, None disables them
+            recorder    (inst):     loadtest.TrafficRecorder to record the
+                                    (sanitized) query string of every GET,
+                                    for loadtest.replay
+
+        FACETS:
+            A request with a facets arg (comma separated column names,
+            dotted paths with __) is answered with the distinct values of
+            those columns among the rows its filters (q, search, column
+            searches) match, most frequent first, instead of a page of rows:
+
+            {"draw": 1, "facets": {"address__city": [{"value": "Reno",
+             "count": 12}, ...]}, "facetsTruncated": {"address__city": true}}
+
+            facets_limit overrides facet_limit for the request; it must be a
+            positive integer and is lowered to facet_max_limit.
+
+        EXPORTS:
+            A request with export=csv or export=ndjson is answered with every
+            row its filters match, in primary key order, streamed as the
+            worker processes of the Exporter serialize them
 
         EXAMPLE:
             Assuming you already have your SA Session object as Session
@@ -43,45 +169,330 @@ def get_resource(Resource, Table, Session, basepath="/"):
 
     """
     class TmpResource(Resource):
+        plan_cache = QueryPlanCache(plan_cache_size) if plan_cache_size else None
+        primary = Session
+        total_counter = staticmethod(get_total_counter(total_count))
+        flights = SingleFlight() if coalesce else None
+        router = ReplicaRouter(read_sessions, replica_policy, Session, staleness) \
+            if read_sessions is not None else None
+        versions = (etags if isinstance(etags, TableVersions) else TableVersions()) \
+            if etags or pk_cache_size or prefetch else None
+        pk_cache = PrimaryKeyCache(versions, pk_cache_size) if pk_cache_size else None
+        if columnar is not None:
+            columnar.watch(Session)
+        facet_cache = LRUCache(facet_cache_size) if facet_cache_size else None
+        exporter = (Exporter() if export is True else export) if export else None
+        if versions is not None:
+            versions.watch(Session)
+        prefetcher = (prefetch if isinstance(prefetch, Prefetcher) else Prefetcher()) if prefetch else None
+        if prefetcher is not None and read_sessions is None and getattr(Session, 'registry', None) is None:
+            raise ValueError("prefetch draws on other threads, it needs read_sessions or a scoped_session")
+
+        @staticmethod
+        def required_indexes():
+            """ List the indexes the configured match modes need """
+            return required_indexes(Table, match_modes or {}, default_match)
+
+        @classmethod
+        def warm_up(cls, columns=None, search="warmup"):
+            """ Get this worker ready before it takes traffic
+
+                Configures the mappers, fills the model metadata caches and
+                runs a one row draw of the usual shapes: ordered by each of
+                columns (datatables column names, Table's own columns by
+                default) and, unless search is empty, searched for it. Their
+                plans get baked, their SQL compiled and the columnar copy,
+                if any, loaded. Run it in an app context if Table.query is
+                Flask-SQLAlchemy's. Returns the number of draws run.
+            """
+            mapper = class_mapper(Table)  # configures all the mappers
+            if columns is None:
+                columns = [attr.key for attr in mapper.column_attrs]
+            for path in columns:
+                curmodel = Table
+                for name in path.replace("__", ".").split("."):
+                    helpme.get_columns(curmodel)
+                    helpme.get_relations(curmodel)
+                    helpme.primary_key_names(curmodel)
+                    if name not in helpme.get_relations(curmodel):
+                        break
+                    curmodel = helpme.get_related_model(curmodel, name)
+
+            shapes = [(i, "") for i in range(len(columns))]
+            if search:
+                shapes.append((0, search))
+            resource = cls()
+            for order_column, value in shapes:
+                resource.route(warm_up_params(columns, order_column, value))
+            return len(shapes)
+
         def get(self):
+            if recorder is not None:
+                recorder.record(request.path, request.query_string)
+
             # parse the url args into a dict
             parsed = parser.parse(request.query_string)
 
+            if "facets" in parsed:
+                return self.serve_facets(parsed)
+
+            if "export" in parsed and self.exporter is not None:
+                return self.serve_export(parsed)
+
+            if not etags or not self.trusts_versions(parsed):
+                return self.serve(parsed)
+
+            # versions are read before querying, so a write racing the
+            # draw can only make its ETag stale, never the other way round
+            etag = self.versions.etag(request_models(Table, parsed, computed=computed), request_signature(parsed))
+            if request.if_none_match.contains(etag):
+                response = current_app.response_class(status=304)
+                response.set_etag(etag)
+                return response
+            result = self.serve(parsed)
+            if "error" in result:
+                return result
+            return result, 200, {"ETag": quote_etag(etag)}
+
+        def trusts_versions(self, parsed, names=()):
+            """ Whether versions tell the responses of the parsed request
+                apart, so they can be tagged and cached by them
+
+                Versions count commits on the primary; a replica may not
+                have caught up with the last one yet, so draws routed to
+                replicas only are once staleness seconds have passed since
+                their tables were last written (never without staleness)
+            """
+            if self.versions is None:
+                return False
+            if self.router is None or self.router.use_primary():
+                return True
+            if self.router.staleness is None:
+                return False
+            return not self.versions.changed_within(
+                request_models(Table, parsed, names, computed), self.router.staleness)
+
+        def serve(self, parsed):
+            if self.prefetcher is None or (self.router is not None and self.router.use_primary()) \
+                    or not self.trusts_versions(parsed):
+                return self.respond(parsed)
+
+            result = self.prefetcher.take(self.prefetch_key(parsed))
+            if result is None:
+                result = self.respond(parsed)
+            else:
+                result = dict(result, draw=int(parsed["draw"]))
+            self.prefetch_next(parsed, result)
+            return result
+
+        def prefetch_key(self, parsed):
+            signature = request_signature(parsed)
+            if self.versions is None:
+                return signature
+            # a write since the prefetch changes the key, so it is not served
+            return self.versions.etag(request_models(Table, parsed, computed=computed), signature)
+
+        def prefetch_next(self, parsed, result):
+            """ Start computing the page after the one in result """
+            try:
+                start, length = int(parsed["start"]), int(parsed["length"])
+            except (KeyError, ValueError):
+                return
+            if "error" in result or length <= 0 or start + length >= result["recordsFiltered"]:
+                return
+            following = dict(parsed, start=str(start + length))
+            app = current_app._get_current_object()
+
+            def compute():
+                with app.app_context():
+                    try:
+                        page = self.route(following)
+                    finally:
+                        if getattr(Session, 'registry', None) is not None:
+                            Session.remove()
+                return None if "error" in page else page
+            self.prefetcher.submit(self.prefetch_key(following), compute)
+
+        def respond(self, parsed):
+            if self.flights is None or (self.router is not None and self.router.use_primary()):
+                return self.route(parsed)
+
+            # identical concurrent draws share one computation, each with its own draw
+            result, shared = self.flights.do(request_signature(parsed), lambda: self.route(parsed))
+            if shared and "draw" in result:
+                result = dict(result, draw=int(parsed["draw"]))
+            return result
+
+        def serve_facets(self, parsed):
+            names = facet_names(parsed)
+            signature = request_signature(dict(
+                (k, v) for k, v in parsed.items() if k not in ("start", "length", "order")))
+            if self.versions is not None:
+                signature = self.versions.etag(request_models(Table, parsed, names, computed), signature)
+            facet_cache = self.facet_cache
+            if self.versions is not None and not self.trusts_versions(parsed, names):
+                facet_cache = None
+            cached = facet_cache.get(signature) if facet_cache is not None else None
+            if cached is not None and time.time() - cached[0] < facet_ttl:
+                return dict(cached[1], draw=int(parsed.get("draw") or 0))
+
+            result = self.route(parsed, self.facets)
+            if facet_cache is not None and "error" not in result:
+                self.facet_cache.set(signature, (time.time(), result))
+            return result
+
+        def serve_export(self, parsed):
+            fmt = parsed["export"]
+            result = self.route(parsed, self.export_chunks)
+            if isinstance(result, dict):
+                return result
+            return current_app.response_class(stream_with_context(result), mimetype=EXPORT_FORMATS[fmt])
+
+        def route(self, parsed, action=None):
+            action = action or self.draw
+            if self.router is None:
+                return action(parsed, Session)
+            with self.router.session() as session:
+                return action(parsed, session)
+
+        def draw(self, parsed, Session):
+            return self.table(parsed, Session).json()
+
+        def export_chunks(self, parsed, Session):
+            """ Return the chunks of the export of the parsed request's rows
+                (planned on Session, read by the exporter's workers), or an
+                error dict
+            """
+            try:
+                check_export_format(parsed["export"])
+                return self.exporter.export(self.table(parsed, Session, total=False), parsed["export"])
+            except (ValueError, DataTablesError) as e:
+                return {
+                    "error": str(e)
+                }
+
+        def facets(self, parsed, Session):
+            return self.table(parsed, Session, total=False).facets_json(
+                facet_names(parsed), facet_limit, facet_max_limit)
+
+        def table(self, parsed, Session, total=True):
+            """ Return the DataTable for the parsed request, reading from Session """
             # column names for this table
             dtcols = get_columns(Table, parsed)
             #for col in dtcols:
             #    print col
 
             # pre build the query so we can add filters to it here
-            try:
-                query = Table.query  # Flask-SQLAlchemy
-            except:
-                query = Session.query(Table)  # vanilla SQLALchemy
+            if Session is self.primary and hasattr(Table, 'query'):
+                query = Table.query  # Flask-SQLAlchemy, bound to the primary
+            else:
+                query = Session.query(Table)  # vanilla SQLALchemy or a replica
+
+            # baked queries, key lists and the in-memory copy only apply to
+            # the plain query on Table
+            plan_cache, pk_cache, columnar_table = self.plan_cache, self.pk_cache, columnar
+            if pk_cache is not None and Session is not self.primary and not self.trusts_versions(parsed):
+                pk_cache = None  # the replica may be behind the key lists' versions
 
             # check if we are filtering the rows some how
             # this uses the restless view code
             if 'q' in parsed.keys():
+                from flask_datatables import views
                 query = views.search(Session, Table, parsed)
+                plan_cache = pk_cache = columnar_table = None
 
-            total_query = 'select count(id) from {0}'.format(Table.__tablename__)                                                                     
-            total_records = Session.execute(total_query).first()
-            if total_records:
-                total_recs = int(total_records[0])
-                log_debug("total recs for table {} is {}".format(Table.__tablename__, total_recs))                                                    
+            if not total or (columnar_table is not None and columnar_table.enabled):
+                # not needed, counted in memory, or exactly if the draw
+                # falls back to SQL
+                total_recs, total_exact = None, True
             else:
-                total_recs = 0
+                total_recs, total_exact = self.total_counter(current_session(Session), Table)
+            log_debug("total recs for table {} is {} (exact: {})".format(
+                Table.__tablename__, total_recs, total_exact))
 
             log_debug(str(query))
             # get our DataTable object
-            dtobj = DataTable( parsed, Table, query, dtcols, total_recs)
-            # return the query result in json
-
-            return dtobj.json()
+            dtobj = DataTable(parsed, Table, query, dtcols, total_recs, total_exact=total_exact,
+                              session=current_session(Session), plan_cache=plan_cache,
+                              time_budget=time_budget, count_cap=count_cap,
+                              match_modes=match_modes, default_match=default_match,
+                              smart_search=smart_search, term_patterns=term_patterns,
+                              pk_cache=pk_cache, columnar=columnar_table, computed=computed,
+                              max_rows=max_rows, max_bytes=max_bytes)
+            return dtobj
     # return stuff that can be passed to api.add_resource
     return (TmpResource, '%s%s' % (basepath,Table.__tablename__), '%s%s' % (basepath,Table.__tablename__))
 
 
 
+def request_signature(parsed):
+    """
+        Helper that normalizes parsed request args into a hashable key,
+        ignoring the args that differ between otherwise identical draws
+    """
+    args = dict((k, v) for k, v in parsed.items() if k not in ("draw", "_"))
+    return json.dumps(args, sort_keys=True, default=str)
+
+
+def warm_up_params(columns, order_column=0, search_value=""):
+    """
+        Helper building the parsed args of a one row draw of columns, as
+        DataTable would get them from a datatables request
+    """
+    return {
+        "draw": "0",
+        "start": "0",
+        "length": "1",
+        "search": {"value": search_value, "regex": "false"},
+        "order": {0: {"column": str(order_column), "dir": "asc"}},
+        "columns": dict((i, {
+            "data": name, "name": "", "searchable": "true", "orderable": "true",
+            "search": {"value": "", "regex": "false"},
+        }) for i, name in enumerate(columns)),
+    }
+
+
+def facet_names(parsed):
+    """
+        Helper returning the column names of the facets arg, given either
+        comma separated or as facets[0], facets[1], ...
+    """
+    facets = parsed.get("facets") or ""
+    if isinstance(facets, dict):
+        facets = ",".join(facets[key] for key in sorted(facets))
+    return [name for name in facets.split(",") if name]
+
+
+def request_models(Table, parsed, paths=(), computed=None):
+    """
+        Helper listing the mapped classes a draw of Table reads: Table, the
+        classes along the dotted column paths (and paths) and, when
+        filtering with q, every class directly related to Table; followed
+        by the tables the computed expressions read
+    """
+    models = [Table]
+    paths = [col[1] for col in get_columns(Table, parsed)] + [path.replace("__", ".") for path in paths]
+    for path in paths:
+        curmodel = Table
+        for name in path.split(".")[:-1]:
+            curmodel = helpme.get_related_model(curmodel, name)
+            if curmodel is None:
+                break
+            models.append(curmodel)
+    if 'q' in parsed.keys():
+        models.extend(helpme.get_related_model(Table, name) for name in helpme.get_relations(Table))
+    models.extend(expression_tables((computed or {}).values()))
+    return [model for i, model in enumerate(models) if model is not None and model not in models[:i]]
+
+
+def current_session(Session):
+    """
+        Helper returning the actual Session behind a scoped_session
+    """
+    registry = getattr(Session, 'registry', None)
+    return registry() if registry is not None else Session
+
+
 def get_columns(Table, parsed):
     """
         Helper function that just builds the tuples datatables needs for the columns
@@ -107,20 +518,134 @@ BOOLEAN_FIELDS = (
 
 DataColumn = namedtuple("DataColumn", ("name", "model_name", "filter"))
 
+# pages longer than this are read from the database and turned into rows
+# this many at a time (with a server side cursor where the dialect has them)
+FETCH_CHUNK = 1000
+
+# the aggregates of to-many relationship paths like tags.count or
+# events.max.timestamp, see DataTable.aggregate_path
+AGGREGATES = {
+    "count": func.count,
+    "min": func.min,
+    "max": func.max,
+    "sum": func.sum,
+    "avg": func.avg,
+}
+
+# a per-column search of a draw, see DataTable.get_column_searches
+ColumnSearch = namedtuple("ColumnSearch", ("column", "value", "regex"))
+
+# the shape of the SQL of a draw, see DataTable.get_plan
+DrawPlan = namedtuple("DrawPlan", ("joins", "search", "column_search", "ordering", "matching", "regex",
+                                   "loads", "computed"))
+
 
 class DataTablesError(ValueError):
     pass
 
 
 class DataTable(object):
-    def __init__(self, params, model, query, columns, total_recs):
+    """ Builds the datatables json response for a query on model
+
+        ARGS:
+            params      (dict):     parsed datatables request
+            model       (class):    SA Table class
+            query       (inst):     SA Query to draw the rows from
+            columns     (list):     column specs, see get_columns
+            total_recs  (int):      recordsTotal, counted from query if None
+            total_exact (bool):     Whether total_recs is exact, reported as
+                                    recordsTotalExact
+            session     (inst):     SA Session, required with plan_cache
+            plan_cache  (inst):     caching.QueryPlanCache to bake the draw
+                                    into; only pass it when query is the
+                                    plain session.query(model)
+            time_budget (float):    Seconds the page and filtered count
+                                    queries may take together; a count
+                                    over budget is reported as approximate
+                                    (recordsFilteredExact false, timedOut
+                                    true), a page over budget is an error
+            count_cap   (int):      Stop counting filtered rows past this
+                                    many; more matches are reported as
+                                    recordsFiltered = count_cap with
+                                    recordsFilteredCapped true
+            match_modes (dict):     Column name -> match mode for searches
+                                    ("exact", "prefix", "contains" or their
+                                    case-insensitive "i" variants), see
+                                    flask_datatables.matching
+            default_match (str):    Match mode of the other columns
+            smart_search (bool):    Split the global search into terms that
+                                    must all match, each in any column
+                                    (quote a phrase to keep it one term);
+                                    otherwise the whole value is one term
+            term_patterns (dict):   Column name -> regex; a term matching
+                                    the regex of some columns is only
+                                    searched in those, so it can use their
+                                    indexes instead of every column's
+            pk_cache    (inst):     caching.PrimaryKeyCache; the first draw
+                                    of a filter and ordering reads all the
+                                    matching primary keys (if the model has
+                                    a single integer one), later pages are
+                                    fetched by key and recordsFiltered is
+                                    their number. At most count_cap keys
+                                    are read, and only in half the
+                                    time_budget; otherwise the draw pages
+                                    and counts without them. Like
+                                    plan_cache, only pass it with the plain
+                                    session.query(model)
+            columnar    (inst):     columnar.ColumnarTable of model to answer
+                                    the draw from memory when it has all
+                                    the columns; also only for the plain
+                                    session.query(model)
+            computed    (dict):     Column name -> SQL expression on model
+                                    rows (a hybrid property like
+                                    Model.attr works too), selected with
+                                    the page instead of computed in Python
+                                    for each row, and usable in searches
+                                    and ordering like a model column
+            max_rows    (int):      Most rows to return, even if length asks
+                                    for more (or for all, with -1)
+            max_bytes   (int):      Most bytes of JSON the rows may take;
+                                    rows are fetched and output in chunks
+                                    and the draw stops at the first row over
+                                    budget. A draw cut short by either is
+                                    reported with dataTruncated true and
+                                    dataTruncatedBy "max_rows"/"max_bytes"
+
+        AGGREGATES:
+            A column path through a to-many relationship ending in count,
+            or in min, max, sum or avg and a column of the related model
+            (tags.count, family.events.max.timestamp; __ in requests), is
+            a computed column: a correlated subquery aggregating the
+            related rows of each row, so no related instance is loaded
+    """
+    def __init__(self, params, model, query, columns, total_recs=None, total_exact=True,
+                 session=None, plan_cache=None, time_budget=None, count_cap=None,
+                 match_modes=None, default_match=DEFAULT_MATCH_MODE, smart_search=True,
+                 term_patterns=None, pk_cache=None, columnar=None, computed=None,
+                 max_rows=None, max_bytes=None):
         self.params = params
         self.model = model
         self.query = query
         self.data = {}
+        self.batch_data = {}
         self.columns = []
         self.columns_dict = {}
         self.total_recs = total_recs
+        self.total_exact = total_exact
+        self.session = session
+        self.plan_cache = plan_cache
+        self.time_budget = time_budget
+        self.count_cap = count_cap
+        self.match_modes = dict((name, check_match_mode(mode))
+                                for name, mode in (match_modes or {}).items())
+        self.default_match = check_match_mode(default_match)
+        self.smart_search = smart_search
+        self.term_patterns = compile_term_patterns(term_patterns)
+        self.pk_cache = pk_cache
+        self.columnar = columnar
+        self.computed = dict(computed or {})
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
 
         for col in columns:
             name, model_name, filter_func = None, None, None
@@ -149,13 +674,22 @@ class DataTable(object):
                 d = DataColumn(name=name, model_name=model_name, filter=None)
                 self.columns.append(d)
             self.columns_dict[d.name] = d
-
+            if d.model_name not in self.computed:
+                aggregate = self.aggregate_path(d.model_name)
+                if aggregate is not None:
+                    self.computed[d.model_name] = self.related_aggregate(*aggregate)
+
+    def join_targets(self, columns):
+        """ Return the relationships to outer join, in order, so the dotted
+            paths of columns can be used in SQL
+        """
+        joins = []
         # get only unique relationships to join
         # fix for when there are multiple columns within the same joined table
         # only eliminates warnings but still...
         seenjoins = []
         seencols = []
-        for column in (col for col in self.columns if "." in col.model_name):
+        for column in (col for col in columns if "." in col.model_name and col.model_name not in self.computed):
             # of of table user model_name can look like family.address.city or more/less dots
             # joincols would be ['family', 'address'] leaving out the actual column, city
             log_debug("column: {}".format(column))
@@ -174,8 +708,7 @@ class DataTable(object):
                 seencols.append(joincols[0])
                 # outer join family
                 log_debug("joincols[0] is {}".format(joincols[0]))
-                self.query = self.query.join(joincols[0], isouter=True)
-                log_debug("query is now: {}".format(self.query))
+                joins.append(joincols[0])
 
             # check if we are doing more than the simple user.famly join (in this example user.family.address)
             if len(joincols) > 1:
@@ -206,10 +739,35 @@ class DataTable(object):
                         # get the remote table object like User.domus rather than XenDomU like above aliased will pull out
                         joinmodel = getattr(curmodel, joincols[i+1])
                         log_debug("joinmodel: {}".format(joinmodel))
-                        #self.query = self.query.join(getattr(curmodel, joincols[i+1]), isouter=True)
-                        self.query = self.query.join(joinmodel, isouter=True)
+                        joins.append(joinmodel)
                         seencols.append(joincols[i+1])
-        log_debug(str(self.query))
+        log_debug("joins: {}".format(joins))
+        return joins
+
+    def load_paths(self, columns):
+        """ Return the distinct relationship paths (like "family.address")
+            of the dotted columns, in order
+        """
+        paths = []
+        for column in columns:
+            if column.model_name in self.computed:
+                continue
+            path = ".".join(column.model_name.split(".")[:-1])
+            if path and path not in paths:
+                paths.append(path)
+        return paths
+
+    def relationship_loader(self, path):
+        """ Return a selectinload option for a dotted relationship path,
+            which loads it for the rows of the page in one query per level
+        """
+        curmodel = self.model
+        loader = None
+        for name in path.split("."):
+            attr = getattr(curmodel, name)
+            loader = selectinload(attr) if loader is None else loader.selectinload(attr)
+            curmodel = helpme.get_related_model(curmodel, name)
+        return loader
 
     @staticmethod
     def coerce_value(key, value):
@@ -233,15 +791,57 @@ class DataTable(object):
     def add_data(self, **kwargs):
         self.data.update(**kwargs)
 
+    def add_batch_data(self, by_key=False, **kwargs):
+        """ Add DT_RowData entries computed for a whole page at once
+
+            Each callable gets the list of the page's instances (or their
+            primary keys if by_key), FETCH_CHUNK at most, and returns a
+            mapping primary key -> value, so one query can serve the page;
+            rows missing from the mapping get None. Composite keys are
+            tuples.
+        """
+        for name, func in kwargs.items():
+            self.batch_data[name] = (func, by_key)
+
+    def batch_values(self, keys, instances=None):
+        """ Return name -> (primary key -> value) of the batch data of a page """
+        return dict((name, func(list(keys) if by_key else instances) or {})
+                    for name, (func, by_key) in self.batch_data.items())
+
+    @staticmethod
+    def instance_key(instance):
+        key = object_mapper(instance).primary_key_from_instance(instance)
+        return key[0] if len(key) == 1 else tuple(key)
+
     def json(self):
         try:
-            return self._json()
+            with self.regex_errors():
+                return self._json()
         except DataTablesError as e:
             return {
                 "error": str(e)
             }
 
+    @contextmanager
+    def regex_errors(self):
+        """ Turn the database rejecting the pattern of a regex search of
+            this draw into a DataTablesError
+
+            check_regex uses Python's syntax, the database its own. The
+            session is rolled back, since PostgreSQL aborts the transaction
+        """
+        try:
+            yield
+        except DBAPIError as e:
+            if not is_regex_error(e) or not (self.is_regex(self.params.get("search")) or any(
+                    search.regex for search in self.get_column_searches())):
+                raise
+            (self.session if self.session is not None else self.query.session).rollback()
+            raise DataTablesError("Invalid regular expression: {}".format(e.orig))
+
     def get_column(self, column):
+        if column.model_name in self.computed:
+            return self.computed[column.model_name]
         if "." in column.model_name:
             column_path = column.model_name.split(".")
 
@@ -259,35 +859,130 @@ class DataTable(object):
 
         return model_column
 
-    def _json(self):
-        draw = self.get_integer_param("draw")
-        start = self.get_integer_param("start")
-        length = self.get_integer_param("length")
+    def match_mode(self, column):
+        return self.match_modes.get(column.name, self.default_match)
+
+    def required_indexes(self):
+        """ Return the IndexRequirements for the match modes of the columns """
+        return required_indexes(self.model, dict(
+            (column.model_name, self.match_mode(column)) for column in self.columns
+            if column.model_name not in self.computed
+            and ("." in column.model_name or hasattr(self.model, column.model_name))))
+
+    def column_type(self, column):
+        return getattr(self.get_column(column), "type", None)
+
+    def term_columns(self, term):
+        """ Return the columns a global search term is searched in
+
+            A term matching the term_patterns of some columns is only
+            searched in those. Otherwise it is searched in every column
+            whose values could contain it, so a word is not compared to
+            numeric columns.
+        """
+        routed = [column for column in self.columns
+                  if column.name in self.term_patterns and self.term_patterns[column.name].match(term)]
+        if routed:
+            return routed
+        return [column for column in self.columns if term_can_match(term, self.column_type(column))]
+
+    def is_to_many(self, column):
+        """ True if the dotted path of column goes through a to-many
+            relationship, so joining it would repeat the rows of model
+        """
+        if column.model_name in self.computed:
+            return False
+        curmodel = self.model
+        for name in column.model_name.split(".")[:-1]:
+            if helpme.is_to_many(curmodel, name):
+                return True
+            curmodel = helpme.get_related_model(curmodel, name)
+        return False
+
+    def column_criterion(self, column, predicate):
+        """ Return predicate(model column) as a criterion on model rows
+
+            Columns behind a to-many relationship are tested with EXISTS
+            (relationship.any/has) rather than through a join, so the main
+            query keeps one row per instance of model
+        """
+        if not self.is_to_many(column):
+            return predicate(self.get_column(column))
+        path = column.model_name.split(".")
+        models = [self.model]
+        for name in path[:-2]:
+            models.append(helpme.get_related_model(models[-1], name))
+        # build from the innermost relationship outwards
+        criterion = predicate(self.get_column(column))
+        for curmodel, name in reversed(list(zip(models, path[:-1]))):
+            attr = getattr(curmodel, name)
+            criterion = attr.any(criterion) if helpme.is_to_many(curmodel, name) else attr.has(criterion)
+        return criterion
+
+    def order_clause(self, column, direction):
+        """ Return the ORDER BY clause for column
+
+            Columns behind a to-many relationship are ordered by the
+            smallest (asc) or largest (desc) related value, computed in a
+            correlated subquery instead of a join
+        """
+        if self.is_to_many(column):
+            model_column = self.aggregate_subquery(column, func.max if direction == "desc" else func.min)
+        else:
+            model_column = self.get_column(column)
+        return desc(model_column) if direction == "desc" else asc(model_column)
+
+    def aggregate_subquery(self, column, aggregate):
+        """ Return a scalar subquery of aggregate over the values of a dotted
+            column related to the current model row
+        """
+        path = column.model_name.split(".")
+        return self.related_aggregate(path[:-1], aggregate, path[-1])
+
+    def aggregate_path(self, model_name):
+        """ Return (relationship path, aggregate, column name) if model_name
+            is an aggregate path (see AGGREGATES), otherwise None
+        """
+        path = model_name.split(".")
+        curmodel, to_many = self.model, False
+        for i, name in enumerate(path):
+            if to_many and name in AGGREGATES:
+                rest = path[i + 1:]
+                if len(rest) == (0 if name == "count" else 1):
+                    return path[:i], AGGREGATES[name], rest[0] if rest else None
+                return None
+            related = helpme.get_related_model(curmodel, name)
+            if related is None:
+                return None
+            to_many = to_many or helpme.is_to_many(curmodel, name)
+            curmodel = related
+        return None
+
+    def related_aggregate(self, relations, aggregate, column_name=None):
+        """ Return a scalar subquery of aggregate over column_name of the
+            instances related to the current model row through the
+            relationship path relations, or over the related rows themselves
+            without column_name (for count)
+        """
+        curmodel = self.model
+        criteria = []
+        for name in relations:
+            prop = getattr(curmodel, name).property
+            criteria.append(prop.primaryjoin)
+            if prop.secondary is not None:
+                criteria.append(prop.secondaryjoin)
+            curmodel = prop.mapper.class_
+        if column_name is None:
+            subquery = select([aggregate()]).select_from(class_mapper(curmodel).local_table)
+        else:
+            subquery = select([aggregate(getattr(curmodel, column_name))])
+        return subquery.where(and_(*criteria)).correlate(class_mapper(self.model).local_table).as_scalar()
 
+    def get_ordering(self):
+        """ Return the requested ordering as a list of (DataColumn, direction) """
         columns = self.params["columns"]
-        ordering = self.params["order"]
-        search = self.params["search"]
-
-        query = self.query
-        # total_records = query.count()
-	total_records = self.total_recs
-
-        # handle searches here rather than using the old searchable function
-        if search.get("value", None):
-            valuestr = '%%%s%%' % str(search["value"])
-
-            # this builds a list of .like() comparisons for the
-            # value passed and every column so it's a global search
-            orlist = []
-            for searchcol in self.columns:
-                model_column = self.get_column(searchcol)
-                orlist.append(model_column.like(unicode(valuestr)))
-
-            # modify the query then return it
-            query = query.filter(and_(or_(*orlist)))
-
-
-        for order in ordering.values():
+        ordering = []
+        for order in self.params["order"].values():
             direction, column = order["dir"], order["column"]
             column = int(column)
 
@@ -300,51 +995,566 @@ class DataTable(object):
             column_name = columns[column]["data"]
             column = self.columns_dict[column_name]
 
-            model_column = self.get_column(column)
-
-            if isinstance(model_column, property):
+            if isinstance(self.get_column(column), property):
                 raise DataTablesError("Cannot order by column {} as it is a property".format(column.model_name))
 
-            query = query.order_by(desc(model_column) if direction == "desc" else asc(model_column))
+            ordering.append((column, "desc" if direction == "desc" else "asc"))
+        return ordering
 
-        filtered_records = query.count()
-        query = query.slice(start, start + length)
+    @staticmethod
+    def is_regex(search):
+        """ Return whether a datatables search dict asks for a regex search """
+        return (search or {}).get("regex") in (True, "true")
 
-        retval = {
+    @staticmethod
+    def check_regex(pattern):
+        try:
+            return check_regex(pattern)
+        except ValueError as e:
+            raise DataTablesError(str(e))
+
+    def get_column_searches(self):
+        """ Return the per-column searches as a list of ColumnSearch """
+        searches = []
+        for column in self.params["columns"].values():
+            search = column.get("search") or {}
+            value = search.get("value")
+            if value and column.get("data") in self.columns_dict:
+                searches.append(ColumnSearch(self.columns_dict[column["data"]], value, self.is_regex(search)))
+        return searches
+
+    def get_plan(self, search_value, column_searches, ordering, search_regex=False):
+        """ Return the DrawPlan of this draw
+
+            Only the dotted columns this draw searches or orders on are
+            joined in SQL, since each join (to-many ones especially) makes
+            the count and page scans more expensive. The relationships shown
+            in the table are loaded for the page's rows afterwards instead.
+            Two draws with the same plan only differ in bound values (search
+            strings, offset, limit), so they can share one baked query.
+            A regex search_value is a single term matched in every column.
+        """
+        if search_regex:
+            terms = [tuple(column.name for column in self.columns)] if search_value else []
+        else:
+            terms = [tuple(column.name for column in self.term_columns(term))
+                     for term in search_terms(search_value, self.smart_search)]
+        used = [self.columns_dict[name] for names in terms for name in names]
+        used.extend(search.column for search in column_searches)
+        used.extend(column for column, direction in ordering)
+        # to-many paths are searched with EXISTS and ordered by subquery
+        used = [column for column in used if not self.is_to_many(column)]
+        joins = self.join_targets([column for i, column in enumerate(used) if column not in used[:i]])
+        return DrawPlan(
+            joins=tuple(joins),
+            search=tuple(terms),
+            column_search=tuple(search.column.name for search in column_searches),
+            ordering=tuple((column.name, direction) for column, direction in ordering),
+            matching=tuple(self.match_mode(column) for column in self.columns),
+            regex=(bool(search_regex and search_value), tuple(search.regex for search in column_searches)),
+            loads=tuple(self.load_paths(self.columns)),
+            computed=tuple(column.name for column in self.columns if column.model_name in self.computed),
+        )
+
+    def plan_steps(self, plan):
+        """ Return the list of query -> query functions building this draw
+
+            Values differing between draws are bindparams, filled in from
+            plan_params, so the steps only depend on the plan
+        """
+        steps = []
+        for target in plan.joins:
+            steps.append(lambda q, target=target: q.join(target, isouter=True))
+
+        # handle searches here rather than using the old searchable function
+        # every term of the global search must match one of its columns,
+        # each compared in its match mode (or as a regex)
+        search_regex, column_regex = plan.regex
+        for t, names in enumerate(plan.search):
+            orlist = []
+            for name in names:
+                searchcol = self.columns_dict[name]
+                mode = self.match_mode(searchcol)
+                if search_regex:
+                    predicate = regex_predicate("dt_term_{}".format(t))
+                else:
+                    predicate = match_predicate(mode, "dt_term_{}_{}".format(t, mode))
+                orlist.append(self.column_criterion(searchcol, predicate))
+            criterion = or_(*orlist) if orlist else false()
+            steps.append(lambda q, criterion=criterion: q.filter(criterion))
+
+        for i, name in enumerate(plan.column_search):
+            column = self.columns_dict[name]
+            if column_regex[i]:
+                predicate = regex_predicate("dt_column_{}".format(i))
+            else:
+                predicate = match_predicate(self.match_mode(column), "dt_column_{}".format(i))
+            criterion = self.column_criterion(column, predicate)
+            steps.append(lambda q, criterion=criterion: q.filter(criterion))
+
+        for name, direction in plan.ordering:
+            clause = self.order_clause(self.columns_dict[name], direction)
+            steps.append(lambda q, clause=clause: q.order_by(clause))
+
+        if plan.loads:
+            loaders = [self.relationship_loader(path) for path in plan.loads]
+            steps.append(lambda q, loaders=loaders: q.options(*loaders))
+        return steps
+
+    def plan_params(self, plan, search_value, column_searches):
+        params = {}
+        search_regex, column_regex = plan.regex
+        if search_regex:
+            params["dt_term_0"] = unicode(search_value)
+        else:
+            terms = search_terms(search_value, self.smart_search)
+            for t, (term, names) in enumerate(zip(terms, plan.search)):
+                for name in names:
+                    column = self.columns_dict[name]
+                    mode = self.match_mode(column)
+                    params.update(search_params(mode, "dt_term_{}_{}".format(t, mode),
+                                                self.column_type(column), unicode(term)))
+        for i, search in enumerate(column_searches):
+            if column_regex[i]:
+                params["dt_column_{}".format(i)] = unicode(search.value)
+            else:
+                params.update(search_params(self.match_mode(search.column), "dt_column_{}".format(i),
+                                            self.column_type(search.column), unicode(search.value)))
+        return params
+
+    def select_computed(self, query, plan):
+        """ Return query also selecting the computed columns of plan """
+        if not plan.computed:
+            return query
+        return query.add_columns(*[
+            self.get_column(self.columns_dict[name]).label("dt_computed_{}".format(i))
+            for i, name in enumerate(plan.computed)
+        ])
+
+    @staticmethod
+    def split_rows(plan, rows):
+        """ Return the instances of rows from select_computed and a list of
+            name -> value dicts of their computed columns (None if none)
+        """
+        if not plan.computed:
+            return rows, None
+        return [row[0] for row in rows], [dict(zip(plan.computed, row[1:])) for row in rows]
+
+    def read_models(self):
+        """ Return the mapped classes the rows and columns are read from,
+            and the tables the computed columns read
+        """
+        models = [self.model]
+        for column in self.columns:
+            curmodel = self.model
+            for name in column.model_name.split(".")[:-1]:
+                curmodel = helpme.get_related_model(curmodel, name)
+                if curmodel is None:
+                    break
+                if curmodel not in models:
+                    models.append(curmodel)
+        models.extend(table for table in expression_tables(self.computed.values()) if table not in models)
+        return models
+
+    def key_column(self):
+        """ Return the primary key column if it is a single integer one """
+        names = helpme.primary_key_names(self.model)
+        if len(names) != 1:
+            return None
+        column = getattr(self.model, names[0])
+        return column if isinstance(getattr(column, "type", None), types.Integer) else None
+
+    def cached_keys(self, plan, params, session, budget):
+        """ Return the ordered primary keys of every filtered row
+
+            The keys come from pk_cache, where the first draw of a plan and
+            search values stores them. Returns None if the model has no
+            single integer primary key, if more rows match than the cache
+            keeps lists of or than count_cap (the count must not read past
+            it), or if reading the keys takes more than half the time left
+            in budget. The draw then pages with OFFSET and counts as usual,
+            and later draws do too until a write to its tables.
+        """
+        key_column = self.key_column()
+        if key_column is None:
+            return None
+        max_rows = self.pk_cache.max_rows
+        if self.count_cap:
+            max_rows = min(self.count_cap, max_rows)
+
+        def compute():
+            query = self.query
+            # the relationship loaders have nothing to load on a key query
+            for step in self.plan_steps(plan._replace(loads=())):
+                query = step(query)
+            query = query.params(params).with_entities(key_column).limit(max_rows + 1)
+            # the rest of the budget is left for the page and count
+            key_budget = TimeBudget(budget.remaining() / 2) if budget is not None else None
+            try:
+                with limited(session, key_budget):
+                    keys = array('q', (key for key, in query))
+            except BudgetExceeded:
+                log_debug("pk cache: reading the keys of {} exceeded the time budget".format(self.model))
+                return None
+            return keys if len(keys) <= max_rows else None
+
+        signature = (self.model, plan, tuple(sorted(params.items())), max_rows)
+        return self.pk_cache.get(signature, self.read_models(), compute)
+
+    def fetch_keys(self, keys, plan):
+        """ Yield the rows (see select_computed) of the instances with
+            primary keys keys, in that order
+
+            Rows are fetched FETCH_CHUNK keys at a time, so a page cut
+            short by max_bytes stops reading at the chunk it ends in
+        """
+        key_column = self.key_column()
+        loaders = [self.relationship_loader(path) for path in plan.loads]
+        for i in range(0, len(keys), FETCH_CHUNK):
+            chunk = keys[i:i + FETCH_CHUNK]
+            query = self.select_computed(self.query.filter(key_column.in_(list(chunk))), plan)
+            if loaders:
+                query = query.options(*loaders)
+            rows = dict((getattr(row[0] if plan.computed else row, key_column.key), row) for row in query)
+            for key in chunk:
+                if key in rows:
+                    yield rows[key]
+
+    def export_query(self):
+        """ Return the query of every filtered row, unordered, with the
+            joins of all the columns, its primary key column and the SQL
+            expressions of the columns, for export.Exporter
+        """
+        key_column = self.key_column()
+        if key_column is None:
+            raise DataTablesError("Cannot export {}: it has no single integer primary key".format(
+                self.model.__name__))
+        for column in self.columns:
+            if self.is_to_many(column):
+                raise DataTablesError("Cannot export column {}: it has several values per row".format(
+                    column.name))
+        search_value, column_searches = self.get_searches()
+        plan = self.get_plan(search_value, column_searches, [], self.is_regex(self.params.get("search")))
+        params = self.plan_params(plan, search_value, column_searches)
+        query = self.query
+        for step in self.plan_steps(plan._replace(joins=tuple(self.join_targets(self.columns)), loads=())):
+            query = step(query)
+        return query.params(params).order_by(None), key_column, [self.get_column(column) for column in self.columns]
+
+    def get_searches(self):
+        """ Return the (global search value, ColumnSearch list) of this
+            draw, after checking their regexes
+        """
+        search = self.params.get("search") or {}
+        search_value = search.get("value", None)
+        if self.is_regex(search) and search_value:
+            self.check_regex(search_value)
+        column_searches = self.get_column_searches()
+        for column_search in column_searches:
+            if column_search.regex:
+                self.check_regex(column_search.value)
+        return search_value, column_searches
+
+    def facets(self, names, limit=20):
+        """ Return the distinct values of the columns named in names among
+            the filtered rows with their counts, most frequent first
+
+            Returns a dict name -> [(value, count)] of at most limit pairs
+            and a dict name -> whether values were left out. Values go
+            through the column's filter, like in the table.
+        """
+        search_value, column_searches = self.get_searches()
+        plan = self.get_plan(search_value, column_searches, [], self.is_regex(self.params.get("search")))
+        params = self.plan_params(plan, search_value, column_searches)
+        query = self.query
+        for step in self.plan_steps(plan._replace(loads=())):
+            query = step(query)
+        query = query.params(params).order_by(None)
+
+        facets, truncated = {}, {}
+        session = self.session if self.session is not None else self.query.session
+        budget = TimeBudget(self.time_budget) if self.time_budget else None
+        try:
+            with limited(session, budget):
+                for name in names:
+                    column, model_column = self.facet_column(name)
+                    joins = [target for target in self.join_targets([column]) if target not in plan.joins]
+                    facet_query = query
+                    for target in joins:
+                        facet_query = facet_query.join(target, isouter=True)
+                    if self.is_to_many(column):
+                        # the join repeats the rows, count each one once
+                        key_names = helpme.primary_key_names(self.model)
+                        count = func.count(distinct(getattr(self.model, key_names[0])))
+                    else:
+                        count = func.count()
+                    rows = facet_query.with_entities(model_column, count).group_by(model_column) \
+                        .order_by(count.desc(), model_column).limit(limit + 1).all()
+                    truncated[name] = len(rows) > limit
+                    facets[name] = [(column.filter(value) if column.filter is not None else value, n)
+                                    for value, n in rows[:limit]]
+        except BudgetExceeded:
+            raise DataTablesError("Query took longer than {} seconds".format(self.time_budget))
+        return facets, truncated
+
+    def facet_column(self, name):
+        """ Return the DataColumn and SQL column to facet name by
+
+            Only computed columns and (possibly related) mapped columns can
+            be faceted, not relationships or other attributes
+        """
+        column = self.columns_dict.get(name) or DataColumn(name, name.replace("__", "."), None)
+        if column.model_name in self.computed:
+            return column, self.computed[column.model_name]
+        try:
+            model_column = self.get_column(column)
+        except AttributeError:
+            model_column = None
+        if isinstance(model_column, QueryableAttribute) and isinstance(model_column.property, ColumnProperty) \
+                or isinstance(model_column, ColumnElement):
+            return column, model_column
+        raise DataTablesError("Cannot facet {}: column not found".format(name))
+
+    def facet_limit(self, default=20, maximum=None):
+        """ Return the facets_limit param, at most maximum, or default
+            without one
+        """
+        if not self.params.get("facets_limit"):
+            return default
+        limit = self.get_integer_param("facets_limit")
+        if limit < 1:
+            raise DataTablesError("Parameter facets_limit is invalid")
+        return limit if maximum is None else min(limit, maximum)
+
+    def facets_json(self, names, limit=20, max_limit=None):
+        """ Return the facets of names as a datatables style response, with
+            at most limit values per facet unless the facets_limit param
+            asks for another number (up to max_limit)
+        """
+        try:
+            draw = self.get_integer_param("draw")
+            with self.regex_errors():
+                facets, truncated = self.facets(names, self.facet_limit(limit, max_limit))
+        except DataTablesError as e:
+            return {
+                "error": str(e)
+            }
+        return {
             "draw": draw,
-            "recordsTotal": total_records,
-            "recordsFiltered": filtered_records,
-            "data": [
-                self.output_instance(instance) for instance in query.all()
-            ]
+            "facets": dict((name, [{"value": value, "count": count} for value, count in pairs])
+                           for name, pairs in facets.items()),
+            "facetsTruncated": truncated,
         }
+
+    def _json(self):
+        draw = self.get_integer_param("draw")
+        start = self.get_integer_param("start")
+        length = self.get_integer_param("length")
+        truncated_by = None
+        if self.max_rows is not None and (length < 0 or length > self.max_rows):
+            length, truncated_by = self.max_rows, "max_rows"
+
+        search_value, column_searches = self.get_searches()
+        search_regex = self.is_regex(self.params["search"])
+        ordering = self.get_ordering()
+        plan = self.get_plan(search_value, column_searches, ordering, search_regex)
+        params = self.plan_params(plan, search_value, column_searches)
+
+        if self.columnar is not None:
+            retval = self.columnar.draw(self, plan, search_value, column_searches, draw, start, length)
+            if retval is not None:
+                return self.truncate(retval, *self.limit_bytes(retval["data"]), truncated_by=truncated_by)
+
+        total_records = self.total_recs
+        if total_records is None:
+            total_records = self.query.count()
+            self.total_exact = True
+
+        session = self.session if self.session is not None else self.query.session
+        budget = TimeBudget(self.time_budget) if self.time_budget else None
+
+        if self.pk_cache is not None:
+            keys = self.cached_keys(plan, params, session, budget)
+            try:
+                if keys is not None:
+                    with limited(session, budget):
+                        data, over_bytes = self.limit_bytes(self.output_rows(plan, self.fetch_keys(
+                            keys[start:start + length] if length >= 0 else keys[start:], plan)))
+            except BudgetExceeded:
+                raise DataTablesError("Query took longer than {} seconds".format(self.time_budget))
+            log_debug("pk cache: {}".format(self.pk_cache.stats))
+            if keys is not None:
+                return self.truncate({
+                    "draw": draw,
+                    "recordsTotal": total_records,
+                    "recordsTotalExact": self.total_exact,
+                    "recordsFiltered": len(keys),
+                }, data, over_bytes, truncated_by)
+
+        if self.plan_cache is not None and self.session is not None:
+            # same shape as an earlier draw -> reuse its baked query
+            bq = self.plan_cache.get(self.model, (self.model, plan),
+                                     lambda: self.plan_steps(plan))
+            def count(limit=None):
+                if limit is None:
+                    return bq(self.session).params(params).count()
+                return bq.with_criteria(
+                    lambda q: q.order_by(None).limit(bindparam("dt_count_limit"))
+                )(self.session).params(params, dt_count_limit=limit).count()
+            page_bq = bq.with_criteria(
+                lambda q: self.select_computed(q, plan).limit(bindparam("dt_limit")).offset(bindparam("dt_offset"))
+            )
+            if self.streamed(length):
+                page_bq = page_bq.with_criteria(lambda q: q.yield_per(FETCH_CHUNK))
+            page = page_bq(self.session).params(params, dt_limit=length, dt_offset=start)
+            log_debug("plan cache: {}".format(self.plan_cache.stats))
+        else:
+            query = self.query
+            for step in self.plan_steps(plan):
+                query = step(query)
+            filtered = query.params(params)
+            def count(limit=None):
+                if limit is None:
+                    return filtered.count()
+                return filtered.order_by(None).limit(limit).count()
+            page = self.select_computed(filtered, plan).slice(start, start + length)
+            if self.streamed(length):
+                page = page.yield_per(FETCH_CHUNK)
+
+        # the page comes first so an expensive count can't starve it
+        try:
+            with limited(session, budget):
+                data, over_bytes = self.limit_bytes(self.output_rows(plan, page))
+        except BudgetExceeded:
+            raise DataTablesError("Query took longer than {} seconds".format(self.time_budget))
+
+        retval = self.truncate({
+            "draw": draw,
+            "recordsTotal": total_records,
+            "recordsTotalExact": self.total_exact,
+        }, data, over_bytes, truncated_by)
+        try:
+            with limited(session, budget):
+                if self.count_cap:
+                    # never count past cap + 1 rows, that's enough to know
+                    # whether there are more than cap
+                    retval["recordsFiltered"] = count(self.count_cap + 1)
+                    if retval["recordsFiltered"] > self.count_cap:
+                        retval["recordsFiltered"] = self.count_cap
+                        retval["recordsFilteredExact"] = False
+                        retval["recordsFilteredCapped"] = True
+                else:
+                    retval["recordsFiltered"] = count()
+        except BudgetExceeded:
+            # out of time: report enough rows for the pager to offer the
+            # next page if this one is full, and say the number is a guess
+            log_debug("filtered count for {} exceeded the time budget".format(self.model))
+            more = length if len(retval["data"]) >= length else 0
+            retval["recordsFiltered"] = start + len(retval["data"]) + more
+            retval["recordsFilteredExact"] = False
+            retval["timedOut"] = True
         #print retval
         return retval
 
-    def output_instance(self, instance):
+    def streamed(self, length):
+        """ Whether a page of length rows is fetched in chunks """
+        return length < 0 or length > FETCH_CHUNK
+
+    def output_rows(self, plan, rows):
+        """ Yield the output rows of rows (see select_computed)
+
+            Rows are read and output FETCH_CHUNK at a time, so batch data
+            callables get a chunk of the page at a time
+        """
+        rows = iter(rows)
+        while True:
+            chunk = list(islice(rows, FETCH_CHUNK))
+            if not chunk:
+                return
+            instances, computed = self.split_rows(plan, chunk)
+            for row in self.output_instances(instances, computed):
+                yield row
+
+    def limit_bytes(self, rows):
+        """ Return the list of the output rows that fit in max_bytes of
+            JSON and whether some were left out; no row is read past the
+            first one over budget
+        """
+        data, size = [], 0
+        for row in rows:
+            if self.max_bytes is not None:
+                size += len(json.dumps(row, default=str)) + 1
+                if size > self.max_bytes:
+                    return data, True
+            data.append(row)
+        return data, False
+
+    def truncate(self, retval, data, over_bytes, truncated_by=None):
+        """ Return retval with data as its rows, saying whether max_bytes or
+            (if the page is full) max_rows cut them short
+        """
+        retval["data"] = data
+        if over_bytes:
+            truncated_by = "max_bytes"
+        elif truncated_by == "max_rows" and len(data) < self.max_rows:
+            truncated_by = None
+        if truncated_by:
+            retval["dataTruncated"] = True
+            retval["dataTruncatedBy"] = truncated_by
+        return retval
+
+    def output_instances(self, instances, computed=None):
+        """ Return the rows of instances, with computed, if given, holding
+            the values of their computed columns (see split_rows)
+        """
+        computed = computed or [None] * len(instances)
+        if not self.batch_data:
+            return [self.output_instance(instance, computed=values)
+                    for instance, values in zip(instances, computed)]
+        keys = [self.instance_key(instance) for instance in instances]
+        batch = self.batch_values(keys, instances)
+        return [
+            self.output_instance(instance, dict((name, values.get(key)) for name, values in batch.items()),
+                                 computed=row_computed)
+            for instance, key, row_computed in zip(instances, keys, computed)
+        ]
+
+    def output_instance(self, instance, batch=None, computed=None):
         returner = {
-            key.name.replace('.', '__'): self.get_value(key, instance) for key in self.columns
+            key.name.replace('.', '__'): self.computed_value(key, computed)
+            if computed and key.name in computed else self.get_value(key, instance)
+            for key in self.columns
         }
 
-        if self.data:
+        if self.data or batch:
             returner["DT_RowData"] = {
                 k: v(instance) for k, v in self.data.items()
             }
+            returner["DT_RowData"].update(batch or {})
 
         return returner
 
+    @staticmethod
+    def computed_value(key, computed):
+        value = computed[key.name]
+        return key.filter(value) if key.filter is not None else value
+
     def get_value(self, key, instance):
         attr = key.model_name
         if "." in attr:
             tmp_list=attr.split(".")
             attr=tmp_list[-1]
-            for sub in tmp_list[:-1]:
+            for i, sub in enumerate(tmp_list[:-1]):
                 oldinstance = instance
                 try:
                     instance = getattr(instance, sub)
                 except Exception:
                     instance = oldinstance
                     break
+                if isinstance(instance, list):
+                    # to-many relationship, one value per related instance
+                    rest = key._replace(model_name=".".join(tmp_list[i + 1:]))
+                    return [self.get_value(rest, item) for item in instance]
 
         if instance:
             if key.filter is not None:
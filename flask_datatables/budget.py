@@ -0,0 +1,151 @@
+"""
+    flask_datatables.budget
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Time budgets for the queries of a draw.
+
+    A :class:`TimeBudget` is started when a draw begins; :meth:`TimeBudget.limit`
+    then runs a block of statements under a database side timeout of whatever
+    is left of it, so a slow statement is cancelled by the database instead of
+    pinning a connection. Timeouts are enforced with ``statement_timeout`` on
+    PostgreSQL, ``max_execution_time`` on MySQL and a progress handler on
+    SQLite; other dialects are not limited. Running out of time raises
+    :exc:`BudgetExceeded`.
+
+"""
+from contextlib import contextmanager
+import time
+
+from sqlalchemy.exc import DBAPIError
+
+#: Number of SQLite virtual machine instructions between two checks of the
+#: deadline by the progress handler.
+SQLITE_PROGRESS_STEPS = 1000
+
+#: PostgreSQL SQLSTATE for "query_canceled", raised by statement_timeout.
+PG_QUERY_CANCELED = '57014'
+
+#: MySQL error number for "maximum statement execution time exceeded".
+MYSQL_EXECUTION_TIME_EXCEEDED = 3024
+
+
+class BudgetExceeded(Exception):
+    """Raised when a statement runs out of the time budget of its draw."""
+    pass
+
+
+def is_timeout_error(exception):
+    """Returns ``True`` if the SQLAlchemy `exception` means the database
+    cancelled a statement because of one of the timeouts set here.
+
+    """
+    if not isinstance(exception, DBAPIError):
+        return False
+    orig = exception.orig
+    if getattr(orig, 'pgcode', None) == PG_QUERY_CANCELED:
+        return True
+    if orig.args and orig.args[0] == MYSQL_EXECUTION_TIME_EXCEEDED:
+        return True
+    return 'interrupted' in str(orig)
+
+
+class TimeBudget(object):
+    """The time left for the statements of one draw.
+
+    `seconds` is the whole budget, starting now.
+
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.deadline = time.time() + seconds
+
+    def remaining(self):
+        return self.deadline - time.time()
+
+    @contextmanager
+    def limit(self, session):
+        """Runs the enclosed statements on `session` under a database side
+        timeout of the remaining budget.
+
+        Raises :exc:`BudgetExceeded` if no time is left or if the database
+        cancels a statement for running past the deadline.
+
+        """
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise BudgetExceeded('No time left in the budget')
+        connection = session.connection()
+        dialect = connection.dialect.name
+        if dialect == 'postgresql':
+            limiter = _postgresql_timeout
+        elif dialect == 'mysql':
+            limiter = _mysql_timeout
+        elif dialect == 'sqlite':
+            limiter = _sqlite_timeout
+        else:
+            limiter = _no_timeout
+        try:
+            with limiter(session, connection, self.deadline, remaining):
+                yield
+        except DBAPIError as exception:
+            if is_timeout_error(exception):
+                raise BudgetExceeded(str(exception.orig))
+            raise
+
+
+@contextmanager
+def limited(session, budget):
+    """Like :meth:`TimeBudget.limit`, but does nothing if `budget` is
+    ``None``.
+
+    """
+    if budget is None:
+        yield
+        return
+    with budget.limit(session):
+        yield
+
+
+@contextmanager
+def _postgresql_timeout(session, connection, deadline, remaining):
+    # The savepoint keeps the transaction usable after a cancelled statement.
+    savepoint = session.begin_nested()
+    connection.execute('SET LOCAL statement_timeout = {0:d}'.format(
+        max(int(remaining * 1000), 1)))
+    try:
+        yield
+    except Exception:
+        savepoint.rollback()
+        raise
+    connection.execute('SET LOCAL statement_timeout = DEFAULT')
+    savepoint.commit()
+
+
+@contextmanager
+def _mysql_timeout(session, connection, deadline, remaining):
+    previous = connection.execute(
+        'SELECT @@SESSION.max_execution_time').scalar()
+    connection.execute('SET SESSION max_execution_time = {0:d}'.format(
+        max(int(remaining * 1000), 1)))
+    try:
+        yield
+    finally:
+        connection.execute('SET SESSION max_execution_time = {0:d}'.format(
+            int(previous or 0)))
+
+
+@contextmanager
+def _sqlite_timeout(session, connection, deadline, remaining):
+    dbapi_connection = connection.connection
+    dbapi_connection.set_progress_handler(
+        lambda: time.time() > deadline, SQLITE_PROGRESS_STEPS)
+    try:
+        yield
+    finally:
+        dbapi_connection.set_progress_handler(None, 0)
+
+
+@contextmanager
+def _no_timeout(session, connection, deadline, remaining):
+    yield
@@ -0,0 +1,257 @@
+"""
+    flask_datatables.caching
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Small caching primitives shared by the datatables resources.
+
+    :class:`LRUCache` is a thread safe, bounded mapping that counts its hits
+    and misses in a :class:`CacheStats` object. :class:`QueryPlanCache` keeps
+    one baked query per "plan signature" (the joins, search and ordering of a
+    draw) so that repeated draws of the same shape reuse SQLAlchemy's cached
+    query construction and compiled SQL instead of rebuilding them.
+    :class:`PrimaryKeyCache` keeps the ordered primary keys of the rows
+    matching a filter, so further pages of it are fetched by key instead of
+    with an ``OFFSET``. :class:`SingleFlight` lets concurrent identical draws
+    share one computation.
+
+"""
+from collections import OrderedDict
+import threading
+
+from sqlalchemy.ext import baked
+
+
+class CacheStats(object):
+    """Counts the hits and misses of a cache."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def lookups(self):
+        return self.hits + self.misses
+
+    @property
+    def hit_rate(self):
+        """The fraction of lookups that were hits, or ``0.0`` before the
+        first lookup.
+
+        """
+        lookups = self.lookups
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def reset(self):
+        self.hits = 0
+        self.misses = 0
+
+    def as_dict(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hit_rate}
+
+    def __repr__(self):
+        return '<CacheStats hits={0}, misses={1}, hit_rate={2:.2f}>'.format(
+            self.hits, self.misses, self.hit_rate)
+
+
+class LRUCache(object):
+    """A thread safe mapping holding at most `maxsize` entries, dropping the
+    least recently used one when full.
+
+    Lookups through :meth:`get` and :meth:`get_or_create` are counted in
+    :attr:`stats`.
+
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.stats = CacheStats()
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.stats.misses += 1
+                return default
+            self._data[key] = value
+            self.stats.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get_or_create(self, key, factory):
+        """Returns the value cached under `key`, calling `factory` with no
+        arguments to create and cache it if there is none.
+
+        """
+        with self._lock:
+            missing = object()
+            value = self.get(key, missing)
+            if value is missing:
+                value = factory()
+                self.set(key, value)
+            return value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class QueryPlanCache(object):
+    """Caches a :class:`sqlalchemy.ext.baked.BakedQuery` per plan signature.
+
+    A plan signature is any hashable value identifying the shape of the SQL
+    built for a draw; the values bound into the statement (search strings,
+    offsets) are not part of it. :meth:`get` returns the baked query for a
+    signature, building it from the given steps the first time only, so the
+    hit rate reported by :attr:`stats` is the fraction of draws that reused
+    an already built statement.
+
+    SQLAlchemy also uses the bakery as the ``compiled_cache`` of the baked
+    statements, so the SQL string of each shape is only compiled once too.
+
+    """
+
+    def __init__(self, size=200):
+        self.bakery = baked.bakery(size=size)
+        self.plans = LRUCache(size)
+
+    @property
+    def stats(self):
+        return self.plans.stats
+
+    def get(self, model, signature, steps_factory):
+        """Returns the baked query for `signature`, creating it if needed.
+
+        `steps_factory` is called without arguments on a miss and must
+        return the list of functions, each taking and returning a
+        :class:`~sqlalchemy.orm.query.Query`, that build the statement on
+        top of ``session.query(model)``. They must only depend on
+        `signature`, since the baked query is keyed by it.
+
+        """
+        return self.plans.get_or_create(
+            signature, lambda: self._bake(model, signature, steps_factory()))
+
+    def _bake(self, model, signature, steps):
+        bq = self.bakery(lambda s: s.query(model), signature)
+        for step in steps:
+            bq += step
+        return bq
+
+    def clear(self):
+        self.plans.clear()
+        self.bakery.cache.clear()
+
+
+class PrimaryKeyCache(object):
+    """Caches the ordered primary keys matched by a filter and ordering.
+
+    Key lists are arrays (``array('q')``, eight bytes a key) of at most
+    `max_rows` keys, `size` of them at most. Every list is stored along with
+    the versions of the tables it was read from, as counted by `versions`
+    (a :class:`~flask_datatables.versioning.TableVersions`), and is not
+    served anymore once a commit bumps one of them.
+
+    """
+
+    def __init__(self, versions, size=64, max_rows=100000):
+        self.versions = versions
+        self.max_rows = max_rows
+        self.lists = LRUCache(size)
+
+    @property
+    def stats(self):
+        return self.lists.stats
+
+    def get(self, key, models, compute):
+        """Returns the key list cached for `key` and the current versions of
+        the tables of `models`.
+
+        On a miss, `compute` is called without arguments and must return the
+        array of keys, or ``None`` if it cannot (too many rows, say). That
+        is cached too, as ``False``, so later draws of `key` return ``None``
+        at once instead of reading the keys again, until the versions
+        change.
+
+        """
+        # versions are read first, so a commit racing compute() can only
+        # make the stored list look older than it is
+        versioned = (key, tuple(self.versions.version(model)
+                                for model in models))
+        keys = self.lists.get(versioned)
+        if keys is None:
+            keys = compute()
+            self.lists.set(versioned, False if keys is None else keys)
+        return keys if keys is not False else None
+
+    def clear(self):
+        self.lists.clear()
+
+
+class _Flight(object):
+    """A computation in progress, shared by everyone asking for its key."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Coalesces concurrent calls for the same key into one computation.
+
+    While a call to :meth:`do` for a key is running, further calls for that
+    key from other threads wait for it and receive the same result (or
+    exception) instead of computing it again. Once the computation ends the
+    key is forgotten, so later calls compute afresh.
+
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """Returns ``(result, shared)``, where `result` is the return value
+        of calling `fn` with no arguments, possibly in another thread, and
+        `shared` is ``True`` if it was computed by another caller.
+
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if leader:
+            try:
+                flight.result = fn()
+            except BaseException as exception:
+                flight.error = exception
+            finally:
+                with self._lock:
+                    del self._flights[key]
+                flight.done.set()
+        else:
+            flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result, not leader
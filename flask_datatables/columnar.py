@@ -0,0 +1,519 @@
+"""
+    flask_datatables.columnar
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    An in-memory, columnar copy of a table that draws are answered from.
+
+    A :class:`ColumnarTable` loads the primary key and a fixed set of columns
+    (dotted paths included) of every row of a model into NumPy arrays, then
+    answers the searches, ordering and paging of a draw with vectorized
+    operations instead of SQL. It is meant for lookup tables of up to a
+    million rows or so; a table growing past `max_rows` is not loaded and
+    its draws go to the database as before.
+
+    The copy is kept fresh incrementally: rows of the model written through
+    a watched session are reloaded by key once the transaction commits, and
+    with a `change_column` (an "updated at" timestamp or revision number)
+    rows changed by anyone are found by querying past the highest value
+    seen. Writes to the related models of dotted columns reload everything,
+    as do `full_refresh` seconds passing. The arrays derived from the rows
+    (search text, sort ranks) are rebuilt on the first draw after a change.
+
+    NumPy is an optional dependency; creating a :class:`ColumnarTable`
+    without it installed raises :exc:`ImportError`.
+
+"""
+import inspect
+import re
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy import func
+from sqlalchemy.orm import selectinload
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.engine import Engine
+
+from flask_datatables.matching import is_text, search_terms, typed_value
+from flask_datatables import apihelpers
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#: Number of keys per ``IN`` clause when reloading changed rows.
+RELOAD_CHUNK = 500
+
+# the value of a dotted column whose relationship is empty
+_NO_OWNER = object()
+
+
+def _text_dtype():
+    # variable width strings (NumPy 2) take far less memory than fixed width
+    # ones, which are as wide as the longest value
+    dtypes = getattr(numpy, 'dtypes', None)
+    string_dtype = getattr(dtypes, 'StringDType', None)
+    return string_dtype() if string_dtype is not None else str
+
+
+def _text(value):
+    if value is None or value is _NO_OWNER:
+        return u''
+    return u'{0}'.format(value)
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) \
+        or type(value).__name__ == 'Decimal'
+
+
+def _objects(values):
+    # numpy.array() would turn equally long lists (to-many values) into a
+    # second dimension
+    array = numpy.empty(len(values), dtype=object)
+    for i, value in enumerate(values):
+        array[i] = value
+    return array
+
+
+def read_path(instance, path):
+    """Returns the raw value of the dotted `path` of `instance`, a list of
+    them for paths through to-many relationships, like
+    :meth:`flask_datatables.DataTable.get_value` before its column filter.
+
+    """
+    names = path.split('.')
+    for i, name in enumerate(names[:-1]):
+        instance = getattr(instance, name)
+        if isinstance(instance, list):
+            rest = '.'.join(names[i + 1:])
+            return [read_path(item, rest) for item in instance]
+        if not instance:
+            return _NO_OWNER
+    return getattr(instance, names[-1])
+
+
+class _Snapshot(object):
+    """The rows of a :class:`ColumnarTable` at one point in time, with the
+    search and sort arrays derived from them computed on first use.
+
+    """
+
+    def __init__(self, keys, values, to_many):
+        self.size = len(keys)
+        self.keys = keys
+        self.values = dict((path, _objects(column))
+                           for path, column in values.items())
+        self.to_many = to_many
+        self._derived = {}
+
+    def _derive(self, key, compute):
+        try:
+            return self._derived[key]
+        except KeyError:
+            return self._derived.setdefault(key, compute())
+
+    def text(self, path, lower=False):
+        if lower:
+            return self._derive(('lower', path),
+                                lambda: numpy.char.lower(self.text(path)))
+        return self._derive(('text', path), lambda: numpy.array(
+            [_text(value) for value in self.values[path]],
+            dtype=_text_dtype()))
+
+    def match(self, path, mode, term, regex=False, column_type=None):
+        """Returns the boolean mask of the rows whose `path` matches `term`
+        in match `mode`, or as a regular expression.
+
+        Like in SQL, the values of a `column_type` that is not a string are
+        searched exactly by comparing them to `term` converted to it.
+
+        """
+        if not regex and mode.endswith('exact') and column_type is not None \
+                and not is_text(column_type):
+            value = typed_value(column_type, term)
+            if self.to_many[path]:
+                return numpy.fromiter(
+                    (value is not None and value in items
+                     for items in self.values[path]), bool, self.size)
+            return numpy.fromiter(
+                (value is not None and item == value
+                 for item in self.values[path]), bool, self.size)
+        if regex:
+            compiled = re.compile(term)
+            test = lambda text: compiled.search(text) is not None
+        else:
+            insensitive = mode.startswith('i')
+            if insensitive:
+                term = term.lower()
+            kind = mode[1:] if insensitive else mode
+        if self.to_many[path]:
+            if not regex:
+                fold = (lambda text: text.lower()) if insensitive else \
+                    (lambda text: text)
+                test = {
+                    'exact': lambda text: fold(text) == term,
+                    'prefix': lambda text: fold(text).startswith(term),
+                    'contains': lambda text: term in fold(text),
+                }[kind]
+            return numpy.fromiter(
+                (any(test(_text(item)) for item in items)
+                 for items in self.values[path]), bool, self.size)
+        if regex:
+            return numpy.fromiter((test(text) for text in self.text(path)),
+                                  bool, self.size)
+        texts = self.text(path, insensitive)
+        if kind == 'exact':
+            return texts == term
+        if kind == 'prefix':
+            return numpy.char.startswith(texts, term)
+        return numpy.char.find(texts, term) >= 0
+
+    def ranks(self, path, direction):
+        """Returns the rank of each row in an ascending sort of `path`,
+        nulls first; to-many paths sort by their least related value, or
+        their greatest one when sorting in descending `direction`.
+
+        """
+        def compute():
+            values = self.values[path]
+            if self.to_many[path]:
+                pick = max if direction == 'desc' else min
+                values = [pick([item for item in items if item is not None],
+                                default=None) for items in values]
+            present = [value for value in values
+                       if value is not None and value is not _NO_OWNER]
+            if present and all(_is_number(value) for value in present):
+                sortable = numpy.array(
+                    [float('-inf') if value is None or value is _NO_OWNER
+                     else float(value) for value in values])
+                return numpy.unique(sortable, return_inverse=True)[1]
+            sortable = numpy.array([_text(value) for value in values],
+                                   dtype=_text_dtype())
+            ranks = numpy.unique(sortable, return_inverse=True)[1] + 1
+            nulls = numpy.fromiter(
+                (value is None or value is _NO_OWNER for value in values),
+                bool, self.size)
+            ranks[nulls] = 0
+            return ranks
+        key = ('ranks', path, direction if self.to_many[path] else 'asc')
+        return self._derive(key, compute)
+
+
+class ColumnarTable(object):
+    """The rows of `model`, with the columns named in `columns` (attribute
+    names or dotted paths), kept in memory to answer draws from.
+
+    `bind` is the :class:`~sqlalchemy.engine.Engine` or session factory the
+    rows are loaded with; each load uses a session of its own.
+    `max_rows` is the most rows loaded, `change_column` the name of a column
+    of `model` whose value grows on every change to a row, checked at most
+    every `refresh_interval` seconds (on every draw if ``None``), and
+    `full_refresh` the seconds after which everything is loaded again.
+
+    """
+
+    def __init__(self, model, columns, bind, max_rows=1000000,
+                 change_column=None, refresh_interval=None, full_refresh=None):
+        if numpy is None:
+            raise ImportError('ColumnarTable needs NumPy, pip install numpy')
+        keys = apihelpers.primary_key_names(model)
+        if len(keys) != 1:
+            raise ValueError('ColumnarTable needs a model with a single'
+                             ' primary key')
+        self.model = model
+        self.key = keys[0]
+        self.paths = [column.replace('__', '.') for column in columns]
+        self.session_factory = sessionmaker(bind=bind) \
+            if isinstance(bind, Engine) else bind
+        self.max_rows = max_rows
+        self.change_column = change_column
+        self.refresh_interval = refresh_interval
+        self.full_refresh = full_refresh
+        self.enabled = True
+        self.related = set()
+        self.to_many = {}
+        for path in self.paths:
+            names = path.split('.')
+            curmodel, to_many = model, False
+            for name in names[:-1]:
+                to_many = to_many or apihelpers.is_to_many(curmodel, name)
+                curmodel = apihelpers.get_related_model(curmodel, name)
+                self.related.add(curmodel)
+            self.to_many[path] = to_many
+        self._keys = None
+        self._values = None
+        self._positions = None
+        self._loaded_at = None
+        self._checked_at = None
+        self._watermark = None
+        self._changed = set()
+        self._reload = False
+        self._snapshot = None
+        self._lock = threading.RLock()
+
+    # -- change tracking -------------------------------------------------
+
+    def watch(self, session):
+        """Reloads the rows written through `session` (a session, scoped
+        session or session class) when their transaction commits.
+
+        """
+        if not event.contains(session, 'after_flush', self._after_flush):
+            event.listen(session, 'after_flush', self._after_flush)
+            event.listen(session, 'after_commit', self._after_commit)
+            event.listen(session, 'after_rollback', self._after_rollback)
+
+    def _pending(self, session):
+        return session.info.setdefault(('datatables_columnar', id(self)),
+                                       {'keys': set(), 'reload': False})
+
+    def _after_flush(self, session, flush_context):
+        pending = self._pending(session)
+        for instance in session.new | session.dirty | session.deleted:
+            if isinstance(instance, self.model):
+                pending['keys'].add(getattr(instance, self.key))
+            elif isinstance(instance, tuple(self.related)):
+                pending['reload'] = True
+
+    def _after_commit(self, session):
+        pending = session.info.pop(('datatables_columnar', id(self)), None)
+        if pending is not None:
+            with self._lock:
+                self._changed.update(pending['keys'])
+                self._reload = self._reload or pending['reload']
+
+    def _after_rollback(self, session):
+        session.info.pop(('datatables_columnar', id(self)), None)
+
+    def invalidate(self, keys=None):
+        """Reloads the rows with primary keys `keys`, or all of them, before
+        the next draw.
+
+        """
+        with self._lock:
+            if keys is None:
+                self._reload = True
+            else:
+                self._changed.update(keys)
+
+    # -- loading ---------------------------------------------------------
+
+    def _query(self, session):
+        query = session.query(self.model)
+        loaders = []
+        for path in self.paths:
+            names = path.split('.')[:-1]
+            if not names:
+                continue
+            curmodel = self.model
+            loader = None
+            for name in names:
+                attr = getattr(curmodel, name)
+                loader = selectinload(attr) if loader is None else \
+                    loader.selectinload(attr)
+                curmodel = apihelpers.get_related_model(curmodel, name)
+            loaders.append(loader)
+        return query.options(*loaders) if loaders else query
+
+    def _row(self, instance):
+        return [read_path(instance, path) for path in self.paths]
+
+    def _load_all(self, session):
+        key_column = getattr(self.model, self.key)
+        if session.query(key_column).limit(self.max_rows + 1).count() > \
+                self.max_rows:
+            self.enabled = False
+            return
+        keys, values = [], dict((path, []) for path in self.paths)
+        for instance in self._query(session).order_by(key_column):
+            keys.append(getattr(instance, self.key))
+            for path, value in zip(self.paths, self._row(instance)):
+                values[path].append(value)
+        self._keys, self._values = keys, values
+        self._positions = dict((key, i) for i, key in enumerate(keys))
+        self._loaded_at = self._checked_at = time.time()
+        self._changed.clear()
+        self._reload = False
+        if self.change_column is not None:
+            self._watermark = session.query(
+                func.max(getattr(self.model, self.change_column))).scalar()
+
+    def _apply(self, keys, instances):
+        """Replaces the rows with primary keys `keys` by `instances`; keys
+        without an instance are removed.
+
+        """
+        found = set()
+        for instance in instances:
+            key = getattr(instance, self.key)
+            found.add(key)
+            row = self._row(instance)
+            position = self._positions.get(key)
+            if position is None:
+                self._positions[key] = len(self._keys)
+                self._keys.append(key)
+                for path, value in zip(self.paths, row):
+                    self._values[path].append(value)
+            else:
+                for path, value in zip(self.paths, row):
+                    self._values[path][position] = value
+        gone = set(key for key in keys if key not in found
+                   and key in self._positions)
+        if gone:
+            kept = [i for i, key in enumerate(self._keys) if key not in gone]
+            self._keys = [self._keys[i] for i in kept]
+            self._values = dict((path, [column[i] for i in kept])
+                                for path, column in self._values.items())
+            self._positions = dict((key, i)
+                                   for i, key in enumerate(self._keys))
+        return bool(found or gone)
+
+    def _reload_keys(self, session, keys):
+        key_column = getattr(self.model, self.key)
+        keys = list(keys)
+        instances = []
+        for i in range(0, len(keys), RELOAD_CHUNK):
+            chunk = keys[i:i + RELOAD_CHUNK]
+            instances.extend(self._query(session).filter(key_column.in_(chunk)))
+        return self._apply(keys, instances)
+
+    def _reload_changed_column(self, session):
+        column = getattr(self.model, self.change_column)
+        query = self._query(session)
+        if self._watermark is not None:
+            query = query.filter(column > self._watermark)
+        instances = query.all()
+        for instance in instances:
+            value = getattr(instance, self.change_column)
+            if value is not None and (self._watermark is None or
+                                      value > self._watermark):
+                self._watermark = value
+        self._checked_at = time.time()
+        return self._apply([], instances)
+
+    def snapshot(self):
+        """Brings the rows up to date and returns them, or ``None`` if the
+        table has more than `max_rows` rows.
+
+        """
+        with self._lock:
+            if not self.enabled:
+                return None
+            now = time.time()
+            full = self._keys is None or self._reload or (
+                self.full_refresh is not None and
+                now - self._loaded_at >= self.full_refresh)
+            check = self.change_column is not None and (
+                self.refresh_interval is None or
+                now - self._checked_at >= self.refresh_interval)
+            if full or self._changed or check:
+                session = self.session_factory()
+                try:
+                    if full:
+                        self._load_all(session)
+                        self._snapshot = None
+                    else:
+                        changed, self._changed = self._changed, set()
+                        if changed and self._reload_keys(session, changed):
+                            self._snapshot = None
+                        if check and self._reload_changed_column(session):
+                            self._snapshot = None
+                finally:
+                    session.close()
+                if not self.enabled:
+                    return None
+            if self._snapshot is None:
+                self._snapshot = _Snapshot(self._keys, self._values,
+                                           self.to_many)
+            return self._snapshot
+
+    # -- drawing ---------------------------------------------------------
+
+    def draw(self, table, plan, search_value, column_searches, draw, start,
+             length):
+        """Returns the datatables response for a draw of the
+        :class:`~flask_datatables.DataTable` `table` with the
+        :class:`~flask_datatables.DrawPlan` `plan`, as ``table.json()``
+        would, or ``None`` if the draw cannot be answered from memory.
+
+        """
+        # per row and per instance data need the instances; data by primary
+        # key can be served
+        if table.data or any(not by_key for func, by_key
+                             in table.batch_data.values()):
+            return None
+        # computed columns are only known to the database
+        if plan.computed:
+            return None
+        if any(column.model_name not in self.to_many
+               for column in table.columns):
+            return None
+        rows = self.snapshot()
+        if rows is None:
+            return None
+
+        columns = table.columns_dict
+        search_regex, column_regex = plan.regex
+        if search_regex:
+            terms = [search_value] if search_value else []
+        else:
+            terms = search_terms(search_value, table.smart_search)
+        mask = numpy.ones(rows.size, bool)
+        for term, names in zip(terms, plan.search):
+            matches = numpy.zeros(rows.size, bool)
+            for name in names:
+                column = columns[name]
+                matches |= rows.match(column.model_name,
+                                      table.match_mode(column), term,
+                                      search_regex, table.column_type(column))
+            mask &= matches
+        for search, regex in zip(column_searches, column_regex):
+            mask &= rows.match(search.column.model_name,
+                               table.match_mode(search.column),
+                               search.value, regex,
+                               table.column_type(search.column))
+
+        indices = numpy.flatnonzero(mask)
+        if plan.ordering and len(indices):
+            sort_keys = []
+            for name, direction in plan.ordering:
+                ranks = rows.ranks(columns[name].model_name, direction)[indices]
+                sort_keys.append(-ranks if direction == 'desc' else ranks)
+            # lexsort sorts by its last key first
+            indices = indices[numpy.lexsort(sort_keys[::-1])]
+        page = indices[start:start + length] if length >= 0 else \
+            indices[start:]
+        keys = [rows.keys[i] for i in page]
+        batch = table.batch_values(keys) if table.batch_data else {}
+
+        return {
+            'draw': draw,
+            'recordsTotal': rows.size,
+            'recordsTotalExact': True,
+            'recordsFiltered': len(indices),
+            'data': [self.output_row(table, rows, i, dict(
+                (name, values.get(key)) for name, values in batch.items()))
+                for i, key in zip(page, keys)],
+        }
+
+    @staticmethod
+    def output_row(table, rows, index, batch=None):
+        """Returns row `index` of `rows` as
+        :meth:`~flask_datatables.DataTable.output_instance` would, with the
+        ``DT_RowData`` in `batch`."""
+        def output(column, value):
+            if isinstance(value, list):
+                return [output(column, item) for item in value]
+            if value is _NO_OWNER:
+                return ''
+            if column.filter is not None:
+                value = column.filter(value)
+            return value() if inspect.isroutine(value) else value
+        row = dict((column.name.replace('.', '__'),
+                    output(column, rows.values[column.model_name][index]))
+                   for column in table.columns)
+        if batch:
+            row['DT_RowData'] = batch
+        return row
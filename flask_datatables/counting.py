@@ -0,0 +1,147 @@
+"""
+    flask_datatables.counting
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Strategies for the ``recordsTotal`` of a datatables response.
+
+    A total count strategy is a callable taking a session and a model class
+    and returning a ``(count, exact)`` pair, where `exact` says whether
+    `count` is the exact number of rows in the model's table right now.
+
+    :class:`ExactTotal` counts every row, :class:`CachedTotal` remembers
+    another strategy's answer for a while and :class:`EstimatedTotal` reads
+    the row estimate kept by the database's query planner, which costs next
+    to nothing even on huge tables. :func:`get_total_counter` turns the
+    names ``'exact'``, ``'cached'`` and ``'estimated'`` into strategies.
+
+"""
+import threading
+import time
+
+from sqlalchemy import func
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+
+class ExactTotal(object):
+    """Counts all the rows of the table with ``SELECT count(*)``."""
+
+    def __call__(self, session, model):
+        return session.query(func.count()).select_from(model).scalar(), True
+
+
+class CachedTotal(object):
+    """Reuses the count from `strategy` (exact by default) for `ttl` seconds.
+
+    A count served from the cache is reported as inexact, since rows may
+    have been added or removed since it was taken.
+
+    """
+
+    def __init__(self, ttl=60, strategy=None):
+        self.ttl = ttl
+        self.strategy = strategy or ExactTotal()
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, session, model):
+        now = time.time()
+        with self._lock:
+            cached = self._counts.get(model)
+        if cached is not None and now - cached[0] < self.ttl:
+            return cached[1], False
+        count, exact = self.strategy(session, model)
+        with self._lock:
+            self._counts[model] = (now, count)
+        return count, exact
+
+    def invalidate(self, model=None):
+        with self._lock:
+            if model is None:
+                self._counts.clear()
+            else:
+                self._counts.pop(model, None)
+
+
+class EstimatedTotal(object):
+    """Reads the planner's row estimate for the table.
+
+    Supported are PostgreSQL (``pg_class.reltuples``), SQLite
+    (``sqlite_stat1``, filled by ``ANALYZE``) and MySQL
+    (``information_schema.tables.table_rows``). If the dialect is not
+    supported or the table has no statistics yet, `fallback` (exact by
+    default) is used instead.
+
+    """
+
+    def __init__(self, fallback=None):
+        self.fallback = fallback or ExactTotal()
+
+    def __call__(self, session, model):
+        table = model.__table__
+        dialect = session.get_bind(model).dialect.name
+        estimator = getattr(self, '_estimate_' + dialect, None)
+        estimate = None
+        if estimator is not None:
+            try:
+                estimate = estimator(session, table)
+            except DBAPIError:
+                # no statistics table, no privileges, ...
+                estimate = None
+        if estimate is None:
+            return self.fallback(session, model)
+        return int(estimate), False
+
+    @staticmethod
+    def _estimate_postgresql(session, table):
+        name = table.name if table.schema is None else \
+            '{0}.{1}'.format(table.schema, table.name)
+        estimate = session.execute(
+            text('SELECT reltuples FROM pg_class'
+                 ' WHERE oid = to_regclass(:name)'),
+            {'name': name}).scalar()
+        # reltuples is -1 (or 0 before PostgreSQL 14) until the first
+        # VACUUM or ANALYZE
+        return estimate if estimate and estimate > 0 else None
+
+    @staticmethod
+    def _estimate_sqlite(session, table):
+        stats = session.execute(
+            text('SELECT stat FROM sqlite_stat1 WHERE tbl = :name'),
+            {'name': table.name}).fetchall()
+        # the first number of each row is the number of rows in the table
+        counts = [int(stat.split()[0]) for stat, in stats if stat]
+        return max(counts) if counts else None
+
+    @staticmethod
+    def _estimate_mysql(session, table):
+        if table.schema is None:
+            schema_clause = 'table_schema = DATABASE()'
+        else:
+            schema_clause = 'table_schema = :schema'
+        return session.execute(
+            text('SELECT table_rows FROM information_schema.tables'
+                 ' WHERE ' + schema_clause + ' AND table_name = :name'),
+            {'name': table.name, 'schema': table.schema}).scalar()
+
+
+#: The strategies known by name to :func:`get_total_counter`.
+STRATEGIES = {
+    'exact': ExactTotal,
+    'cached': CachedTotal,
+    'estimated': EstimatedTotal,
+}
+
+
+def get_total_counter(strategy):
+    """Returns the total count strategy named by `strategy` (one of the keys
+    of :data:`STRATEGIES`), or `strategy` itself if it is already a callable.
+
+    """
+    if callable(strategy):
+        return strategy
+    try:
+        return STRATEGIES[strategy]()
+    except KeyError:
+        raise ValueError('Unknown total count strategy {0!r}, expected one of'
+                         ' {1}'.format(strategy, ', '.join(sorted(STRATEGIES))))
@@ -0,0 +1,186 @@
+"""
+    flask_datatables.export
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Exports of every row a draw's filters match, as CSV or NDJSON.
+
+    One cursor and one core serializing a few million rows is slow, and
+    mostly because of the serializing. An :class:`Exporter` splits the
+    filtered rows into ranges of at most `chunk_size` primary keys and has a
+    pool of worker processes, each with its own engine, read and serialize
+    one range at a time. Chunks are handed back in key order as they come,
+    so an export can be streamed into a response or written to a file
+    without holding more than a few chunks in memory.
+
+    Rows are exported in primary key order, whatever the draw's ordering,
+    with their raw column values (the columns' Python filters are not
+    applied). Workers connect to the database by URL, so an in-memory SQLite
+    database cannot be exported with workers.
+
+"""
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import io
+import json
+import os
+
+from sqlalchemy import bindparam
+from sqlalchemy import create_engine
+from sqlalchemy import func
+from sqlalchemy.orm import class_mapper
+
+#: The formats :meth:`Exporter.export` writes, with their mimetypes.
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+#: The engines of the worker processes, by process id and URL.
+_ENGINES = {}
+
+
+def check_format(fmt):
+    """Raises :exc:`ValueError` if `fmt` is not one of :data:`FORMATS`,
+    otherwise returns it.
+
+    """
+    if fmt not in FORMATS:
+        raise ValueError('Unknown export format {0!r}, expected one of'
+                         ' {1}'.format(fmt, ', '.join(sorted(FORMATS))))
+    return fmt
+
+
+def _engine(url):
+    # a forked worker inherits the engines (and their connections) of its
+    # parent, which it must not use
+    key = (os.getpid(), url)
+    if key not in _ENGINES:
+        _ENGINES[key] = create_engine(url)
+    return _ENGINES[key]
+
+
+def serialize(names, rows, fmt):
+    """Returns `rows`, sequences of values for the columns `names`, as CSV
+    lines (without a header) or NDJSON lines.
+
+    """
+    buffer = io.StringIO()
+    if fmt == 'csv':
+        csv.writer(buffer, lineterminator='\n').writerows(rows)
+    else:
+        for row in rows:
+            buffer.write(json.dumps(dict(zip(names, row)), default=str))
+            buffer.write('\n')
+    return buffer.getvalue()
+
+
+def export_range(url, sql, params, names, fmt):
+    """Runs `sql` with `params` on the database at `url` and returns its
+    rows serialized by :func:`serialize`, less their first column (the
+    primary key). This is what the worker processes run.
+
+    """
+    with _engine(url).connect() as connection:
+        rows = [row[1:] for row in connection.execute(sql, params)]
+    return serialize(names, rows, fmt)
+
+
+class Exporter(object):
+    """Exports the rows a :class:`~flask_datatables.DataTable` matches on
+    `workers` processes, `chunk_size` rows at a time.
+
+    Workers connect to `url`, the URL of the table's session by default.
+    With no `workers` the ranges are read and serialized one after the
+    other in the calling process instead.
+
+    """
+
+    def __init__(self, workers=4, chunk_size=50000, url=None):
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.url = url
+
+    def export(self, table, fmt='csv'):
+        """Returns an iterator of the chunks of the export of `table` in
+        `fmt`, one of :data:`FORMATS`.
+
+        The filters are checked, and the ranges planned by reading the
+        filtered primary keys, before this returns; only the ranges are
+        read when iterating, each by a worker.
+
+        """
+        check_format(fmt)
+        query, key_column, columns = table.export_query()
+        names = [column.name.replace('.', '__') for column in table.columns]
+        bind = query.session.get_bind(mapper=class_mapper(table.model))
+        url = self.url or str(bind.url)
+
+        # labels keep a column shown twice (or the key) from being selected
+        # only once
+        entities = [key_column.label('dt_export_key')] + [
+            column.label('dt_export_{0}'.format(i)) for i, column in enumerate(columns)]
+        statement = query.with_entities(*entities).filter(
+            key_column >= bindparam('dt_export_lo', type_=key_column.type),
+            key_column < bindparam('dt_export_hi', type_=key_column.type),
+        ).order_by(key_column).statement
+        compiled = statement.compile(dialect=bind.dialect)
+        sql = str(compiled)
+
+        def range_params(low, high):
+            params = dict(compiled.params, dt_export_lo=low, dt_export_hi=high)
+            if bind.dialect.positional:
+                return tuple(params[name] for name in compiled.positiontup)
+            return params
+
+        bounds = self.key_bounds(query, key_column)
+        ranges = [range_params(low, high) for low, high in zip(bounds, bounds[1:])]
+        header = serialize(names, [names], fmt) if fmt == 'csv' else ''
+        return self._chunks(header, url, sql, ranges, names, fmt)
+
+    def key_bounds(self, query, key_column):
+        """Returns the first key of each range of `chunk_size` keys matched
+        by `query`, and one past the last key.
+
+        The keys are numbered by the database (with ``row_number()``, which
+        SQLite has since 3.25), so only the bounds are sent back.
+
+        """
+        numbered = query.with_entities(
+            key_column.label('dt_export_key'),
+            func.row_number().over(order_by=key_column).label('dt_export_row'),
+        ).order_by(None).subquery()
+        bounds = [key for key, in query.session.query(numbered.c.dt_export_key).filter(
+            (numbered.c.dt_export_row - 1) % self.chunk_size == 0).order_by(numbered.c.dt_export_key)]
+        if bounds:
+            last = query.with_entities(func.max(key_column)).order_by(None).scalar()
+            bounds.append(last + 1)
+        return bounds
+
+    def _chunks(self, header, url, sql, ranges, names, fmt):
+        if header:
+            yield header
+        if not self.workers:
+            for params in ranges:
+                yield export_range(url, sql, params, names, fmt)
+            return
+
+        with ProcessPoolExecutor(self.workers) as pool:
+            # a few ranges ahead of the one being sent, not all of them
+            pending = deque()
+            try:
+                for params in ranges:
+                    pending.append(pool.submit(export_range, url, sql, params, names, fmt))
+                    if len(pending) >= 2 * self.workers:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def export_to_file(self, table, path, fmt='csv'):
+        """Writes the export of `table` in `fmt` to the file at `path`."""
+        with io.open(path, 'w', encoding='utf-8', newline='') as f:
+            for chunk in self.export(table, fmt):
+                f.write(chunk)
@@ -0,0 +1,357 @@
+"""
+    flask_datatables.loadtest
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Recording of the draws hitting datatables resources, and their replay.
+
+    A :class:`TrafficRecorder` passed to
+    :func:`~flask_datatables.get_resource` as `recorder` keeps the path and
+    query string of every GET the resource answers, sanitized by
+    :func:`sanitize_query` so search values typed by users are not stored,
+    and optionally appends them to a file as JSON lines from a background
+    thread, so recording adds no file write to the requests.
+
+    :func:`replay` sends recorded requests again, from `concurrency`
+    threads, to a Flask app (through its test client) or to a server at a
+    URL, and returns a :class:`LoadReport` of the latency percentiles,
+    throughput and errors of each endpoint. Against an app, the SQL
+    statements each endpoint ran are counted too, so two releases can be
+    compared on the same traffic before deploying::
+
+        python -m flask_datatables.loadtest traffic.ndjson --app myapp:app
+
+"""
+from collections import namedtuple
+import argparse
+import atexit
+import hashlib
+import importlib
+import json
+import math
+import re
+import sys
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+try:
+    from urllib.parse import parse_qsl, urlencode
+    from urllib.request import urlopen
+    from urllib.error import HTTPError
+except ImportError:  # Python 2
+    from urllib import urlencode
+    from urllib2 import urlopen, HTTPError
+    from urlparse import parse_qsl
+
+#: The query string args holding search values typed by users.
+SEARCH_ARG_REGEX = re.compile(r'^(search|columns\[\d+\]\[search\])\[value\]$')
+
+#: The query string arg holding the restless search of a draw, as JSON.
+FILTER_ARG = 'q'
+
+#: Args dropped from recorded query strings: jQuery's cache buster.
+DROPPED_ARGS = ('_',)
+
+#: A recorded request: its path, query string and when it was answered.
+Request = namedtuple('Request', ('path', 'query', 'time'))
+
+
+def mask_value(value, salt=''):
+    """Returns `value` with each word replaced by a token derived from its
+    hash, so equal words stay equal (and numbers numeric) but cannot be
+    read back. Double quotes and whitespace are kept, so smart searches
+    keep their terms.
+
+    """
+    def mask(match):
+        word = match.group(0)
+        digest = hashlib.sha1((salt + word).encode('utf-8')).hexdigest()[:8]
+        if word.isdigit():
+            return str(int(digest, 16))[:len(word)]
+        return 'w' + digest
+    return re.sub(r'[^\s"]+', mask, value)
+
+
+def mask_json(value, salt=''):
+    """Returns the decoded JSON `value` with its strings masked by
+    :func:`mask_value`, keeping their ``%`` wildcards, and the digits of its
+    numbers replaced the same way, so numbers stay numbers.
+
+    """
+    if isinstance(value, dict):
+        return dict((key, mask_json(item, salt)) for key, item in value.items())
+    if isinstance(value, list):
+        return [mask_json(item, salt) for item in value]
+    if value is None or isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return json.loads(re.sub(r'\d+', lambda match: mask_value(match.group(0), salt),
+                                 json.dumps(value)))
+    return '%'.join(mask_value(part, salt) for part in value.split('%'))
+
+
+def mask_search(search, salt=''):
+    """Returns the decoded restless search `search` (the :data:`FILTER_ARG`
+    of a draw) with the values its filters compare to masked by
+    :func:`mask_json`. Names, operators and orderings are kept.
+
+    """
+    if isinstance(search, dict):
+        return dict((key, mask_json(item, salt) if key == 'val' else mask_search(item, salt))
+                    for key, item in search.items())
+    if isinstance(search, list):
+        return [mask_search(item, salt) for item in search]
+    return search
+
+
+def sanitize_query(query, salt=''):
+    """Returns the query string `query` with its search values masked by
+    :func:`mask_value`, the values of its restless search by
+    :func:`mask_search`, and the :data:`DROPPED_ARGS` left out.
+
+    A restless search that is not valid JSON is masked as a whole.
+
+    """
+    pairs = []
+    for key, value in parse_qsl(query, keep_blank_values=True):
+        if key in DROPPED_ARGS:
+            continue
+        if value and SEARCH_ARG_REGEX.match(key):
+            value = mask_value(value, salt)
+        elif value and key == FILTER_ARG:
+            try:
+                value = json.dumps(mask_search(json.loads(value), salt))
+            except ValueError:
+                value = mask_value(value, salt)
+        pairs.append((key, value))
+    return urlencode(pairs)
+
+
+class TrafficRecorder(object):
+    """Records the requests of the resources it is passed to.
+
+    Requests are kept in :attr:`requests` (the last `size` of them) and,
+    if `path` is given, appended to that file by a background thread every
+    `flush_interval` seconds, on exit and by :meth:`flush`. `sanitize` is
+    called with each query string and returns what to record; pass ``None``
+    to record query strings as they are.
+
+    """
+
+    def __init__(self, path=None, size=10000, sanitize=sanitize_query,
+                 flush_interval=1.0):
+        self.path = path
+        self.size = size
+        self.sanitize = sanitize
+        self.flush_interval = flush_interval
+        self.requests = []
+        self._pending = []
+        self._writer = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def record(self, path, query):
+        """Records a GET of `path` with the query string `query`."""
+        if isinstance(query, bytes):
+            query = query.decode('utf-8')
+        if self.sanitize is not None:
+            query = self.sanitize(query)
+        entry = Request(path, query, time.time())
+        with self._lock:
+            self.requests.append(entry)
+            del self.requests[:-self.size]
+            if self.path is None:
+                return
+            self._pending.append(entry)
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write,
+                                                name='TrafficRecorder')
+                self._writer.daemon = True
+                self._writer.start()
+                atexit.register(self.flush)
+
+    def _write(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        """Appends the requests recorded since the last flush to the file."""
+        # one flush at a time, so entries are written in order
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+            if pending and self.path is not None:
+                with open(self.path, 'a') as f:
+                    f.write(''.join(json.dumps(entry._asdict()) + '\n'
+                                    for entry in pending))
+
+
+def load_traffic(path):
+    """Returns the list of :class:`Request` recorded in the file at `path`."""
+    with open(path) as f:
+        return [Request(**json.loads(line)) for line in f if line.strip()]
+
+
+def percentile(values, fraction):
+    """Returns the nearest rank `fraction` percentile of the sorted list
+    `values`, or ``None`` if it is empty.
+
+    """
+    if not values:
+        return None
+    rank = min(max(int(math.ceil(fraction * len(values))), 1), len(values))
+    return values[rank - 1]
+
+
+class EndpointStats(object):
+    """The latencies, errors and SQL statements of the requests replayed
+    to one endpoint.
+
+    """
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.statements = 0
+
+    def as_dict(self, elapsed):
+        latencies = sorted(self.latencies)
+        return {
+            'requests': len(latencies),
+            'errors': self.errors,
+            'p50': percentile(latencies, 0.50),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99),
+            'throughput': len(latencies) / elapsed if elapsed else 0.0,
+            'statements': self.statements,
+        }
+
+
+class LoadReport(object):
+    """The result of a :func:`replay`: :attr:`endpoints` maps each path to
+    its :class:`EndpointStats` and :attr:`elapsed` is the wall time of the
+    whole replay, which throughputs are computed over.
+
+    Statements are only counted when replaying to an app.
+
+    """
+
+    def __init__(self, endpoints, elapsed, concurrency):
+        self.endpoints = endpoints
+        self.elapsed = elapsed
+        self.concurrency = concurrency
+
+    def as_dict(self):
+        return dict((path, stats.as_dict(self.elapsed))
+                    for path, stats in self.endpoints.items())
+
+    def format(self):
+        """Returns the report as a text table, latencies in milliseconds."""
+        lines = ['{0:<30} {1:>8} {2:>6} {3:>8} {4:>8} {5:>8} {6:>8} {7:>10}'.format(
+            'endpoint', 'requests', 'errors', 'p50', 'p95', 'p99', 'req/s', 'statements')]
+        for path, stats in sorted(self.as_dict().items()):
+            lines.append('{0:<30} {1:>8} {2:>6} {3:>8.1f} {4:>8.1f} {5:>8.1f} {6:>8.1f} {7:>10}'.format(
+                path, stats['requests'], stats['errors'], (stats['p50'] or 0) * 1000,
+                (stats['p95'] or 0) * 1000, (stats['p99'] or 0) * 1000, stats['throughput'],
+                stats['statements']))
+        lines.append('{0} concurrent clients, {1:.2f}s'.format(self.concurrency, self.elapsed))
+        return '\n'.join(lines)
+
+
+def replay(target, requests, concurrency=8, repeat=1):
+    """Sends each of `requests` (:class:`Request` tuples) `repeat` times to
+    `target` from `concurrency` threads and returns a :class:`LoadReport`.
+
+    `target` is a Flask app, which is sent the requests through test
+    clients, or the base URL of a server (``http://localhost:5000``).
+    Responses with a status of 400 or more, or a JSON body with an
+    ``error``, count as errors.
+
+    """
+    queue = [request for _ in range(repeat) for request in requests]
+    queue.reverse()
+    endpoints = dict((request.path, EndpointStats()) for request in requests)
+    lock = threading.Lock()
+    current = threading.local()
+
+    def count_statement(*args):
+        path = getattr(current, 'path', None)
+        if path is not None:
+            with lock:
+                endpoints[path].statements += 1
+
+    def worker():
+        client = target.test_client() if hasattr(target, 'test_client') else None
+        while True:
+            with lock:
+                if not queue:
+                    return
+                request = queue.pop()
+            url = request.path + ('?' + request.query if request.query else '')
+            current.path = request.path
+            started = time.time()
+            try:
+                if client is not None:
+                    response = client.get(url)
+                    status, body = response.status_code, response.get_data()
+                else:
+                    try:
+                        response = urlopen(target.rstrip('/') + url)
+                        status, body = response.getcode(), response.read()
+                    except HTTPError as e:
+                        status, body = e.code, b''
+                failed = status >= 400 or b'"error"' in body[:200]
+            except Exception:
+                failed = True
+            finally:
+                current.path = None
+            latency = time.time() - started
+            with lock:
+                stats = endpoints[request.path]
+                stats.latencies.append(latency)
+                stats.errors += failed
+
+    event.listen(Engine, 'before_cursor_execute', count_statement)
+    try:
+        started = time.time()
+        threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - started
+    finally:
+        event.remove(Engine, 'before_cursor_execute', count_statement)
+    return LoadReport(endpoints, elapsed, concurrency)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Replay recorded datatables traffic and report latencies.')
+    parser.add_argument('traffic', help='file written by a TrafficRecorder')
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--app', help='Flask app to replay to, as module:attribute')
+    target.add_argument('--url', help='base URL of a server to replay to')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args(argv)
+
+    if args.app:
+        module, _, name = args.app.partition(':')
+        app = getattr(importlib.import_module(module), name or 'app')
+    else:
+        app = args.url
+    report = replay(app, load_traffic(args.traffic), args.concurrency, args.repeat)
+    if args.json:
+        print(json.dumps(report.as_dict(), indent=2, sort_keys=True))
+    else:
+        print(report.format())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,404 @@
+"""
+    flask_datatables.matching
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    How a search value is matched against a column.
+
+    Each column of a table can use one of the :data:`MATCH_MODES`. The
+    ``exact`` and ``prefix`` modes (and their case-insensitive ``i``
+    variants, which compare ``lower(column)``) can be answered from a btree
+    index, unlike ``contains``, whose leading wildcard forces a scan. User
+    input is always escaped, so ``%`` and ``_`` typed into a search box
+    match themselves rather than acting as wildcards.
+
+    :func:`required_indexes` lists the indexes each configured mode needs.
+    Columns that are not strings are searched exactly (in both ``exact``
+    modes) by comparing them to the search value converted to their type,
+    see :func:`typed_value`, so their indexes still apply. The other modes
+    compare their text form, which no index covers.
+
+    A global search is "smart": :func:`search_terms` splits it into terms
+    (keeping double quoted phrases together), a row must match every term and
+    a term may match any column. :func:`term_can_match` lets terms skip the
+    columns they can never match, numeric ones in particular.
+
+    Regular expression searches are run by the database, see
+    :func:`regex_predicate`. SQLite has no regular expression function of its
+    own, so one backed by a cache of compiled patterns is registered on every
+    SQLite connection. Patterns are checked by :func:`check_regex` first,
+    but that uses Python's syntax, so the database may still reject one;
+    :func:`is_regex_error` recognizes its error.
+
+"""
+from collections import namedtuple
+import re
+
+import sqlite3
+
+from sqlalchemy import bindparam
+from sqlalchemy import cast
+from sqlalchemy import event
+from sqlalchemy import func
+from sqlalchemy import types
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
+
+from flask_datatables.caching import LRUCache
+from flask_datatables import apihelpers
+
+#: The match modes understood by :func:`match_predicate`.
+MATCH_MODES = ('exact', 'iexact', 'prefix', 'iprefix', 'contains',
+               'icontains')
+
+#: The mode of columns without one of their own. It is what searches always
+#: did before match modes existed.
+DEFAULT_MATCH_MODE = 'contains'
+
+#: The escape character of LIKE patterns. It has no special meaning in the
+#: string literals of any supported database, unlike the backslash.
+LIKE_ESCAPE = '/'
+
+#: The most terms a smart search is split into; further terms are ignored.
+#: Every term adds an OR of all the columns to the statement and a distinct
+#: term count is a distinct statement to compile and cache.
+MAX_SEARCH_TERMS = 8
+
+#: A term of a smart search: a double quoted phrase or a run of non-blanks.
+TERM_REGEX = re.compile(r'"([^"]*)"|(\S+)')
+
+#: The characters of the text form of a number.
+NUMERIC_CHARACTERS = frozenset('0123456789.-+eE')
+
+#: The search values equal to the values of boolean columns.
+BOOLEAN_VALUES = {'true': True, 't': True, '1': True,
+                  'false': False, 'f': False, '0': False}
+
+#: The longest regular expression accepted by :func:`check_regex`.
+MAX_REGEX_LENGTH = 200
+
+#: A group with a quantifier inside that is itself repeated, like ``(a+)+``
+#: or ``(\w*\s?)*``, the usual source of catastrophic backtracking.
+NESTED_QUANTIFIER_REGEX = re.compile(r'\((?:[^()\\]|\\.)*[*+}](?:[^()\\]|\\.)*\)[*+{]')
+
+#: Python only syntax: named groups and their backreferences, ``(?P...)``.
+PYTHON_ONLY_REGEX = re.compile(r'\(\?P')
+
+#: PostgreSQL SQLSTATE for "invalid_regular_expression".
+PG_INVALID_REGEX = '2201B'
+
+#: MySQL error numbers of the regular expression errors (ER_REGEXP_*).
+MYSQL_REGEX_ERRORS = frozenset(range(3684, 3701))
+
+#: The compiled patterns of the SQLite ``REGEXP`` function.
+SQLITE_PATTERNS = LRUCache(256)
+
+
+def check_match_mode(mode):
+    """Raises :exc:`ValueError` if `mode` is not one of :data:`MATCH_MODES`,
+    otherwise returns it.
+
+    """
+    if mode not in MATCH_MODES:
+        raise ValueError('Unknown match mode {0!r}, expected one of'
+                         ' {1}'.format(mode, ', '.join(MATCH_MODES)))
+    return mode
+
+
+def escape_like(value, escape=LIKE_ESCAPE):
+    """Returns `value` with the LIKE wildcards ``%`` and ``_`` (and the
+    `escape` character itself) escaped by `escape`.
+
+    """
+    return value.replace(escape, escape * 2).replace('%', escape + '%') \
+        .replace('_', escape + '_')
+
+
+def search_pattern(mode, value):
+    """Returns the value to bind for a search for `value` in `mode`."""
+    if mode.startswith('i'):
+        value = value.lower()
+        mode = mode[1:]
+    if mode == 'exact':
+        return value
+    if mode == 'prefix':
+        return escape_like(value) + '%'
+    return '%' + escape_like(value) + '%'
+
+
+def is_text(column_type):
+    """Returns ``True`` if the values of `column_type` are strings."""
+    return isinstance(column_type, types.String)
+
+
+def as_text(column):
+    """Returns `column`, cast to a string unless it already is one, so that
+    it can be compared with the (string) search values.
+
+    """
+    if is_text(getattr(column, 'type', None)):
+        return column
+    return cast(column, types.String)
+
+
+def typed_value(column_type, value):
+    """Returns the search `value` converted to the Python type of the values
+    of `column_type`, or ``None``, which no row equals, if it is not the text
+    form of one. Dates must be in ISO 8601 format.
+
+    """
+    if isinstance(column_type, types.Boolean):
+        return BOOLEAN_VALUES.get(value.lower())
+    try:
+        if isinstance(column_type, (types.Date, types.DateTime)):
+            if not apihelpers.ISO8601_REGEX.match(value):
+                return None
+            parsed = apihelpers.parse_date_string(value)
+            return parsed if isinstance(column_type, types.DateTime) else parsed.date()
+        if isinstance(column_type, (types.Integer, types.Numeric)):
+            return column_type.python_type(value)
+    except (ArithmeticError, ValueError):
+        return None
+    return value
+
+
+def typed_param_name(name, column_type):
+    """Returns the name of the bind parameter holding the value of the bind
+    parameter `name` converted by :func:`typed_value` for `column_type`.
+
+    """
+    return '{0}_{1}'.format(name, type(column_type).__name__.lower())
+
+
+def search_params(mode, name, column_type, value):
+    """Returns a dictionary of the bind parameters the criterion built by
+    ``match_predicate(mode, name)`` for a column of `column_type` needs to
+    search for `value`.
+
+    """
+    if mode.endswith('exact') and not is_text(column_type):
+        return {typed_param_name(name, column_type): typed_value(column_type, value)}
+    return {name: search_pattern(mode, value)}
+
+
+def match_predicate(mode, name):
+    """Returns a function that takes a column and returns the criterion
+    matching it in `mode` against the bind parameter called `name`, whose
+    value should come from :func:`search_params`.
+
+    Columns that are not strings are compared with their own type in the
+    ``exact`` modes, case insensitively or not, and as text otherwise.
+
+    """
+    check_match_mode(mode)
+    insensitive = mode.startswith('i')
+    exact = mode.endswith('exact')
+
+    def predicate(column):
+        column_type = getattr(column, 'type', None)
+        if exact and not is_text(column_type):
+            return column == bindparam(typed_param_name(name, column_type),
+                                       type_=column_type)
+        column = as_text(column)
+        if insensitive:
+            column = func.lower(column)
+        value = bindparam(name, type_=types.String())
+        if exact:
+            return column == value
+        return column.like(value, escape=LIKE_ESCAPE)
+    return predicate
+
+
+def search_terms(value, smart=True):
+    """Returns the list of terms a global search for `value` must all match.
+
+    Unless `smart` is false, `value` is split on whitespace, except inside
+    double quotes, into at most :data:`MAX_SEARCH_TERMS` terms.
+
+    """
+    if not value:
+        return []
+    if not smart:
+        return [value]
+    terms = [phrase or word for phrase, word in TERM_REGEX.findall(value)]
+    return [term for term in terms if term][:MAX_SEARCH_TERMS]
+
+
+def term_can_match(term, column_type):
+    """Returns ``False`` if no value of a column of `column_type` can match
+    `term`, which is the case for non-numeric terms and numeric columns.
+
+    """
+    if isinstance(column_type, (types.Integer, types.Numeric)):
+        return NUMERIC_CHARACTERS.issuperset(term)
+    return True
+
+
+def compile_term_patterns(term_patterns):
+    """Returns `term_patterns`, a dictionary mapping column names to regular
+    expressions, with the expressions compiled to match whole terms.
+
+    """
+    return dict((name, re.compile(r'(?:{0})\Z'.format(
+        getattr(pattern, 'pattern', pattern)), getattr(pattern, 'flags', 0)))
+        for name, pattern in (term_patterns or {}).items())
+
+
+def check_regex(pattern):
+    """Raises :exc:`ValueError` if `pattern` is not a regular expression that
+    is safe to search with, otherwise returns it.
+
+    A pattern must compile, be at most :data:`MAX_REGEX_LENGTH` characters
+    long, have no nested quantifiers and none of the syntax only Python
+    understands. Databases run patterns with backtracking engines too, so a
+    pathological one would keep a worker (and the database) busy for as
+    long as its statement is allowed to run.
+
+    """
+    if len(pattern) > MAX_REGEX_LENGTH:
+        raise ValueError('Regular expression longer than {0} characters'
+                         .format(MAX_REGEX_LENGTH))
+    if NESTED_QUANTIFIER_REGEX.search(pattern):
+        raise ValueError('Regular expression with nested quantifiers')
+    if PYTHON_ONLY_REGEX.search(pattern):
+        raise ValueError('Regular expression with (?P...) groups')
+    try:
+        re.compile(pattern)
+    except re.error as exception:
+        raise ValueError('Invalid regular expression: {0}'.format(exception))
+    return pattern
+
+
+def is_regex_error(exception):
+    """Returns ``True`` if the SQLAlchemy `exception` means the database
+    rejected a regular expression.
+
+    """
+    if not isinstance(exception, DBAPIError):
+        return False
+    orig = exception.orig
+    if getattr(orig, 'pgcode', None) == PG_INVALID_REGEX:
+        return True
+    if orig.args and orig.args[0] in MYSQL_REGEX_ERRORS:
+        return True
+    # on SQLite, sqlite_regexp is the only function registered here
+    return isinstance(orig, sqlite3.OperationalError) and \
+        'user-defined function raised exception' in str(orig)
+
+
+class regexp_match(FunctionElement):
+    """``column`` matches the regular expression ``pattern``, rendered as
+    ``~`` on PostgreSQL and ``REGEXP`` elsewhere.
+
+    """
+    type = types.Boolean()
+    name = 'regexp_match'
+
+
+@compiles(regexp_match)
+def _compile_regexp_match(element, compiler, **kw):
+    column, pattern = element.clauses.clauses
+    return '{0} REGEXP {1}'.format(compiler.process(column, **kw),
+                                   compiler.process(pattern, **kw))
+
+
+@compiles(regexp_match, 'postgresql')
+def _compile_regexp_match_postgresql(element, compiler, **kw):
+    column, pattern = element.clauses.clauses
+    return '{0} ~ {1}'.format(compiler.process(column, **kw),
+                              compiler.process(pattern, **kw))
+
+
+def regex_predicate(name):
+    """Returns a function that takes a column and returns the criterion
+    matching it against the regular expression bound to the parameter
+    called `name`.
+
+    """
+    def predicate(column):
+        return regexp_match(as_text(column),
+                            bindparam(name, type_=types.String()))
+    return predicate
+
+
+def sqlite_regexp(pattern, value):
+    """The SQLite ``REGEXP`` function: ``value REGEXP pattern`` calls it as
+    ``regexp(pattern, value)``.
+
+    """
+    if pattern is None or value is None:
+        return None
+    compiled = SQLITE_PATTERNS.get_or_create(
+        pattern, lambda: re.compile(pattern))
+    return compiled.search(value if isinstance(value, str) else
+                           str(value)) is not None
+
+
+@event.listens_for(Engine, 'connect')
+def register_sqlite_regexp(dbapi_connection, connection_record=None):
+    """Adds :func:`sqlite_regexp` to a new SQLite connection."""
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.create_function('regexp', 2, sqlite_regexp)
+
+
+class IndexRequirement(namedtuple('IndexRequirement',
+                                  ('column', 'mode', 'table', 'definition',
+                                   'method'))):
+    """An index that lets searches on `column` in `mode` avoid a scan.
+
+    `definition` is the indexed expression, with its PostgreSQL operator
+    class if one is needed, and `method` the PostgreSQL index method.
+
+    """
+
+    @property
+    def statement(self):
+        """A PostgreSQL ``CREATE INDEX`` statement for this index."""
+        name = 'ix_{0}_{1}_{2}'.format(self.table, self.column.replace('.', '_'),
+                                       self.mode)
+        using = '' if self.method == 'btree' else ' USING ' + self.method
+        return 'CREATE INDEX {0} ON {1}{2} ({3})'.format(
+            name, self.table, using, self.definition)
+
+
+def required_indexes(model, match_modes, default=DEFAULT_MATCH_MODE):
+    """Returns an :class:`IndexRequirement` for each column in `match_modes`,
+    a dictionary mapping column names of `model` (dotted or with ``__`` for
+    related columns) to match modes.
+
+    Prefix searches need the ``text_pattern_ops`` operator class on
+    PostgreSQL unless the database uses the C collation. ``contains``
+    searches cannot use a btree index at all; the requirement reported for
+    them is a trigram index from the ``pg_trgm`` extension.
+
+    Columns that are not strings need a plain index for exact searches and
+    are left out for the other modes: they are searched as text, and the
+    text form of some types (dates among them) depends on settings, so
+    PostgreSQL cannot index it.
+
+    """
+    requirements = []
+    for name, mode in sorted(match_modes.items()):
+        mode = check_match_mode(mode or default)
+        path = name.replace('__', '.').split('.')
+        curmodel = model
+        for relation in path[:-1]:
+            curmodel = apihelpers.get_related_model(curmodel, relation)
+        expression = path[-1]
+        if not is_text(getattr(getattr(curmodel, expression), 'type', None)):
+            if mode.endswith('exact'):
+                requirements.append(IndexRequirement(
+                    name, mode, curmodel.__tablename__, expression, 'btree'))
+            continue
+        if mode.startswith('i'):
+            expression = 'lower({0})'.format(expression)
+        method = 'btree'
+        if mode.endswith('prefix'):
+            expression += ' text_pattern_ops'
+        elif mode.endswith('contains'):
+            expression += ' gin_trgm_ops'
+            method = 'gin'
+        requirements.append(IndexRequirement(
+            name, mode, curmodel.__tablename__, expression, method))
+    return requirements
@@ -0,0 +1,89 @@
+"""
+    flask_datatables.prefetch
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Speculative computation of the draws users are likely to ask for next.
+
+    A :class:`Prefetcher` runs draws on a small pool of background threads
+    and keeps their results in a bounded cache until they are asked for, or
+    until they are too old to be served. The resources use it to compute
+    page k+1 of a table while the user is still looking at page k.
+
+"""
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+from flask_datatables.caching import LRUCache
+
+
+class Prefetcher(object):
+    """Computes results ahead of time on `workers` background threads.
+
+    At most `size` results are kept, each for at most `ttl` seconds, and at
+    most `max_pending` computations (twice `workers` by default) are queued
+    or running; further :meth:`submit` calls are dropped rather than queued,
+    so prefetching never falls behind the requests it is meant to speed up.
+
+    :attr:`stats` counts how many :meth:`take` calls found their result.
+
+    """
+
+    def __init__(self, workers=2, size=32, ttl=30, max_pending=None):
+        self.ttl = ttl
+        self.max_pending = max_pending or 2 * workers
+        self.results = LRUCache(size)
+        self._executor = ThreadPoolExecutor(workers)
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    @property
+    def stats(self):
+        return self.results.stats
+
+    def take(self, key):
+        """Returns the result computed for `key` and forgets it, or ``None``
+        if there is none or it is older than :attr:`ttl`.
+
+        """
+        entry = self.results.get(key)
+        if entry is None:
+            return None
+        self.results.pop(key)
+        computed, result = entry
+        if time.time() - computed > self.ttl:
+            return None
+        return result
+
+    def submit(self, key, fn):
+        """Computes `fn()` in the background and keeps its result for `key`,
+        unless `fn` raises or returns ``None``.
+
+        Returns ``False`` without doing anything if a result for `key` is
+        already kept or being computed, or if too many computations are
+        pending.
+
+        """
+        with self._lock:
+            if key in self._pending or key in self.results or \
+                    len(self._pending) >= self.max_pending:
+                return False
+            self._pending.add(key)
+        self._executor.submit(self._run, key, fn)
+        return True
+
+    def _run(self, key, fn):
+        try:
+            result = fn()
+            if result is not None:
+                self.results.set(key, (time.time(), result))
+        except Exception:
+            # a prefetch is only a guess; the real request will recompute
+            # it and report whatever went wrong
+            pass
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait)
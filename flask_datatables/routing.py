@@ -0,0 +1,129 @@
+"""
+    flask_datatables.routing
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Routes the read-only datatables queries to replica databases.
+
+    A :class:`ReplicaRouter` hands out a session on one of several replicas
+    for each draw, picked round-robin or by the fewest draws in flight. If a
+    staleness bound is given, draws that follow a write flushed on the
+    primary within the same request context (and less than that many
+    seconds ago) use the primary session instead, so a user never reads back
+    data older than their own write.
+
+"""
+from contextlib import contextmanager
+import itertools
+import threading
+import time
+
+from flask import g
+from flask import has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import sessionmaker
+
+#: The replica selection policies understood by :class:`ReplicaRouter`.
+POLICIES = ('round_robin', 'least_loaded')
+
+
+def note_write(*args):
+    """Records the time of a write in the current request context.
+
+    This is registered as an ``after_flush`` listener on the primary session
+    by :class:`ReplicaRouter`; call it by hand for writes that do not go
+    through that session.
+
+    """
+    if has_request_context():
+        g.datatables_last_write = time.time()
+
+
+def last_write():
+    """Returns the time of the last write noted in the current request
+    context, or ``None``.
+
+    """
+    if has_request_context():
+        return getattr(g, 'datatables_last_write', None)
+    return None
+
+
+class ReplicaRouter(object):
+    """Picks the session each draw reads from.
+
+    `replicas` is either a single session factory or a list of replicas,
+    each an :class:`~sqlalchemy.engine.Engine` or a callable returning a new
+    :class:`~sqlalchemy.orm.Session` (a :class:`sessionmaker`, for example).
+
+    `policy` is ``'round_robin'`` or ``'least_loaded'``; the latter picks the
+    replica with the fewest draws currently in flight on this worker.
+
+    `primary` is the primary session (or scoped session). If it and
+    `staleness` (in seconds) are given, writes flushed on it are tracked and
+    a draw in the same request context as a write less than `staleness`
+    seconds old reads from `primary` instead of a replica.
+
+    """
+
+    def __init__(self, replicas, policy='round_robin', primary=None,
+                 staleness=None):
+        if policy not in POLICIES:
+            raise ValueError('Unknown replica policy {0!r}, expected one of'
+                             ' {1}'.format(policy, ', '.join(POLICIES)))
+        if callable(replicas):
+            replicas = [replicas]
+        if not replicas:
+            raise ValueError('At least one replica is required')
+        self.factories = [sessionmaker(bind=r) if isinstance(r, Engine) else r
+                          for r in replicas]
+        self.policy = policy
+        self.primary = primary
+        self.staleness = staleness
+        self.in_flight = [0] * len(self.factories)
+        self._cycle = itertools.cycle(range(len(self.factories)))
+        self._lock = threading.Lock()
+        if primary is not None and staleness is not None:
+            event.listen(primary, 'after_flush', note_write)
+
+    def use_primary(self):
+        """Returns ``True`` if the current draw must read from the primary
+        because of a recent write in the same request context.
+
+        """
+        if self.primary is None or self.staleness is None:
+            return False
+        written = last_write()
+        return written is not None and time.time() - written < self.staleness
+
+    def _pick(self):
+        with self._lock:
+            if self.policy == 'least_loaded':
+                index = min(range(len(self.factories)),
+                            key=self.in_flight.__getitem__)
+            else:
+                index = next(self._cycle)
+            self.in_flight[index] += 1
+            return index
+
+    def _release(self, index):
+        with self._lock:
+            self.in_flight[index] -= 1
+
+    @contextmanager
+    def session(self):
+        """Context manager yielding the session to run a draw on.
+
+        Replica sessions are closed on exit; the primary is left alone.
+
+        """
+        if self.use_primary():
+            yield self.primary
+            return
+        index = self._pick()
+        session = self.factories[index]()
+        try:
+            yield session
+        finally:
+            session.close()
+            self._release(index)
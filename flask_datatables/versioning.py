@@ -0,0 +1,161 @@
+"""
+    flask_datatables.versioning
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Version counters for tables, used to answer conditional GETs.
+
+    A :class:`TableVersions` counts the committed transactions writing to
+    each table through the sessions it watches. Tables are only bumped once
+    the transaction commits: a draw reading between a flush and its commit
+    sees the old rows, so it must not record the new version. The ETag of a draw hashes the versions of the
+    tables the draw reads together with the normalized request, so it only
+    changes when the response could have; a client sending it back in
+    ``If-None-Match`` gets a ``304 Not Modified`` without any query being
+    run.
+
+    Counters live in the worker process and only see writes made through
+    the watched sessions of that process. Each process has its own
+    :attr:`TableVersions.epoch` in the ETags, so a restarted worker never
+    confirms an ETag it did not hand out, but a write made by another
+    process (or by raw SQL) goes unnoticed until the same process writes
+    to the table too. Call :meth:`TableVersions.bump` for such writes, or
+    subclass it to keep the counters somewhere shared.
+
+    Versions only describe the primary database: a replica may serve the
+    rows of a version for a while after it was bumped. See
+    :meth:`TableVersions.changed_within`.
+
+"""
+import hashlib
+import threading
+import time
+import uuid
+
+from sqlalchemy import event
+from sqlalchemy.orm import class_mapper
+from sqlalchemy.orm import object_mapper
+from sqlalchemy.sql.schema import Table
+from sqlalchemy.sql.util import find_tables
+
+
+def tables_of(target):
+    """Returns the tables of `target`, a mapped class or a
+    :class:`~sqlalchemy.schema.Table`.
+
+    """
+    if isinstance(target, Table):
+        return [target]
+    return list(class_mapper(target).tables)
+
+
+def expression_tables(expressions):
+    """Returns the tables read by the SQL `expressions`, subqueries
+    included.
+
+    """
+    tables = []
+    for expression in expressions:
+        for table in find_tables(expression, check_columns=True):
+            if isinstance(table, Table) and table not in tables:
+                tables.append(table)
+    return tables
+
+
+class TableVersions(object):
+    """Per table version counters, bumped by the commits of watched
+    sessions.
+
+    """
+
+    def __init__(self):
+        self.epoch = uuid.uuid4().hex
+        self._versions = {}
+        self._changed = {}
+        self._lock = threading.Lock()
+
+    def watch(self, session):
+        """Bumps the tables written through `session` (a session, scoped
+        session or session class) when their transaction commits, from now
+        on.
+
+        """
+        if not event.contains(session, 'after_flush', self._after_flush):
+            event.listen(session, 'after_flush', self._after_flush)
+            event.listen(session, 'after_bulk_update', self._after_bulk)
+            event.listen(session, 'after_bulk_delete', self._after_bulk)
+            event.listen(session, 'after_commit', self._after_commit)
+            event.listen(session, 'after_rollback', self._after_rollback)
+
+    def bump(self, *models):
+        """Records a write to the tables of each mapped class (or
+        :class:`~sqlalchemy.schema.Table`) in `models`.
+
+        """
+        tables = set()
+        for model in models:
+            tables.update(tables_of(model))
+        self._bump_tables(tables)
+
+    def _bump_tables(self, tables):
+        now = time.time()
+        with self._lock:
+            for table in tables:
+                self._versions[table] = self._versions.get(table, 0) + 1
+                self._changed[table] = now
+
+    def _pending(self, session):
+        return session.info.setdefault(('datatables_versions', id(self)), set())
+
+    def _after_flush(self, session, flush_context):
+        pending = self._pending(session)
+        for instance in session.new | session.dirty | session.deleted:
+            pending.update(object_mapper(instance).tables)
+
+    def _after_bulk(self, context):
+        mapper = getattr(context, 'mapper', None)
+        if mapper is not None:
+            self._pending(context.session).update(mapper.tables)
+
+    def _after_commit(self, session):
+        tables = session.info.pop(('datatables_versions', id(self)), None)
+        if tables:
+            self._bump_tables(tables)
+
+    def _after_rollback(self, session):
+        session.info.pop(('datatables_versions', id(self)), None)
+
+    def version(self, model):
+        """Returns the versions of the tables of the mapped class (or the
+        :class:`~sqlalchemy.schema.Table`) `model`.
+
+        """
+        with self._lock:
+            return tuple(self._versions.get(table, 0)
+                         for table in tables_of(model))
+
+    def changed_within(self, models, seconds):
+        """Returns ``True`` if the tables of any of `models` (mapped classes
+        or tables) were bumped less than `seconds` ago, so a replica lagging
+        by up to that long may not have their current version yet.
+
+        """
+        since = time.time() - seconds
+        with self._lock:
+            return any(self._changed.get(table, 0) > since
+                       for model in models for table in tables_of(model))
+
+    def etag(self, models, signature):
+        """Returns the ETag of a draw reading the tables of `models` (mapped
+        classes or tables) for the request normalized to the string
+        `signature`.
+
+        """
+        parts = [self.epoch]
+        names = dict((('table:' + model.fullname) if isinstance(model, Table) else
+                      '{0}.{1}'.format(model.__module__, model.__name__), model)
+                     for model in models)
+        for name, model in sorted(names.items()):
+            parts.append('{0}={1}'.format(
+                name, ','.join(map(str, self.version(model)))))
+        parts.append(signature)
+        return hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()
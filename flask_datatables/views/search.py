@@ -22,10 +22,13 @@ from sqlalchemy import or_
 from sqlalchemy.ext.associationproxy import AssociationProxy
 from sqlalchemy.orm.attributes import InstrumentedAttribute
 
-from flask_datatables.views.apihelpers import session_query
-from flask_datatables.views.apihelpers import get_related_association_proxy_model
-from flask_datatables.views.apihelpers import primary_key_names
-from flask_datatables.views.apihelpers import get_related_model
+from flask_datatables.apihelpers import session_query
+from flask_datatables.apihelpers import get_related_association_proxy_model
+from flask_datatables.apihelpers import primary_key_names
+from flask_datatables.apihelpers import get_related_model
+
+# `inspect.getargspec` is deprecated in Python 3 and gone in 3.11.
+getargspec = getattr(inspect, 'getfullargspec', None) or inspect.getargspec
 
 debug = False
 
@@ -403,9 +406,7 @@ class QueryBuilder(object):
         """
         # raises KeyError if operator not in OPERATORS
         opfunc = OPERATORS[operator]
-        # In Python 3.0 or later, this should be `inspect.getfullargspec`
-        # because `inspect.getargspec` is deprecated.
-        numargs = len(inspect.getargspec(opfunc).args)
+        numargs = len(getargspec(opfunc).args)
         # raises AttributeError if `fieldname` or `relation` does not exist
         writedebug(debug, "Model: {}, Relation: {}, fieldname: {}".format(str(model), str(relation), fieldname))
         field = getattr(model, relation or fieldname)
@@ -34,9 +34,10 @@ setup(
     ],
     install_requires=[
         'querystring_parser==1.2.3',
-        'sqlalchemy>=1.0.11',
+        'sqlalchemy>=1.2',
         'flask>=0.10.1',
         'flask-restful>=0.3.5',
         'Faker==0.7.12',
+        'futures; python_version < "3"',
     ],
 )
@@ -27,3 +27,14 @@ class Address(Base):
 
     def __repr__(self):
         return "{}".format(self.description)
+
+
+
+class Tag(Base):
+    __tablename__ = 'tags'
+
+    id = Column(Integer, primary_key=True)
+    name = Column(Text)
+    user_id = Column(Integer, ForeignKey('users.id'))
+
+    user = relationship("User", backref=backref("tags"))
@@ -5,6 +5,7 @@ from querystring_parser import parser
 import json
 from .models import *
 from flask_datatables import *
+from flask_datatables import views
 import os
 
 
@@ -248,3 +249,1067 @@ class TestDataTables:
         str_response = response.data.decode('utf-8')
         obj = json.loads(str_response)
         assert len(obj['data']) == 10
+
+    def test_model_metadata_cache(self):
+        """ Introspection results are cached per model and dropped when
+            SQLAlchemy configures a new mapper (which may add backrefs)
+        """
+        from sqlalchemy import Column, DateTime, Integer, Text, ForeignKey
+        from sqlalchemy.ext.declarative import declarative_base
+        from sqlalchemy.orm import relationship, backref, configure_mappers
+        from flask_datatables import apihelpers
+
+        # throwaway models, so the backref added below doesn't outlive the test
+        LocalBase = declarative_base()
+
+        class Author(LocalBase):
+            __tablename__ = 'authors'
+            id = Column(Integer, primary_key=True)
+            created_at = Column(DateTime)
+
+        class Book(LocalBase):
+            __tablename__ = 'books'
+            id = Column(Integer, primary_key=True)
+            author_id = Column(Integer, ForeignKey('authors.id'))
+            author = relationship(Author, backref=backref("books"))
+
+        configure_mappers()
+        assert apihelpers.get_relations(Author) == ['books']
+        assert apihelpers.primary_key_names(Author) == ['id']
+        assert apihelpers.is_date_field(Author, 'created_at')
+        assert Author in apihelpers._MODEL_METADATA
+
+        class Note(LocalBase):
+            __tablename__ = 'notes'
+            id = Column(Integer, primary_key=True)
+            body = Column(Text)
+            author_id = Column(Integer, ForeignKey('authors.id'))
+            author = relationship(Author, backref=backref("notes"))
+
+        configure_mappers()
+        assert Author not in apihelpers._MODEL_METADATA
+        assert sorted(apihelpers.get_relations(Author)) == ['books', 'notes']
+        assert apihelpers.get_related_model(Author, 'notes') is Note
+
+        # names from requests that are no attribute are not cached
+        apihelpers.get_relations(User)
+        cached = len(apihelpers._MODEL_METADATA[User])
+        for i in range(20):
+            assert apihelpers.get_related_model(User, 'bogus%d' % i) is None
+            DataTable(self.make_params(columns=("bogus%d__count" % i,)), User, self.session.query(User),
+                      [("bogus%d__count" % i, "bogus%d.count" % i)])
+        assert len(apihelpers._MODEL_METADATA[User]) == cached
+
+    def test_strings_to_dates(self):
+        """ ISO 8601 strings take the fast path, other formats still go
+            through dateutil, and lists (for the "in" operator) are converted
+            element by element
+        """
+        import datetime
+        from flask_datatables.apihelpers import strings_to_dates
+
+        result = strings_to_dates(User, {
+            "created_at": "2015-01-02T03:04:05.5",
+            "full_name": "2015-01-02",
+        })
+        assert result["created_at"] == datetime.datetime(2015, 1, 2, 3, 4, 5, 500000)
+        assert result["full_name"] == "2015-01-02"
+
+        result = strings_to_dates(User, {"created_at": ["2015-01-02", "Jan 3 2015"]})
+        assert result["created_at"] == [datetime.datetime(2015, 1, 2),
+                                        datetime.datetime(2015, 1, 3)]
+
+        urlfilter = json.dumps({"filters": [
+            {"name": "created_at", "op": "gt", "val": "2000-01-01T00:00:00"}]})
+        req = self.make_params(urlfilter=urlfilter)
+        query = views.search(self.session, User, req)
+        assert query.count() == 10
+
+    def test_lazy_views(self):
+        """ The restless views are only imported by draws filtering with q,
+            and their helpers can still be imported from the old path
+        """
+        import subprocess
+        import sys
+
+        code = ("import sys, flask_datatables; "
+                "print('flask_datatables.views' in sys.modules)")
+        out = subprocess.check_output([sys.executable, "-c", code])
+        assert out.strip() == b"False"
+
+        from flask_datatables import apihelpers
+        from flask_datatables.views import apihelpers as old
+        assert old is apihelpers
+
+    def test_plan_cache(self):
+        """ Draws with the same joins, search and ordering reuse one baked
+            query; only the bound values change
+        """
+        from flask_datatables.caching import QueryPlanCache
+
+        user, addr = self.make_user("Qzx Sally", "Qzx Sally Road")
+        user2, addr2 = self.make_user("Qzx Billy", "Qzx Billy Road")
+        self.session.add_all((user, user2))
+        self.session.commit()
+
+        cache = QueryPlanCache()
+        columns = ["id", ("name", "full_name"), ("address", "address.description")]
+
+        def draw(value, start=0):
+            req = self.make_params(search={"value": value}, start=start,
+                                   order=[{"column": 2, "dir": "desc"}])
+            table = DataTable(req, User, self.session.query(User), columns,
+                              session=self.session, plan_cache=cache)
+            return table.json()
+
+        result = draw("Qzx")
+        assert result["recordsFiltered"] == 2
+        assert [row["name"] for row in result["data"]] == ["Qzx Sally", "Qzx Billy"]
+        assert cache.stats.misses == 1 and cache.stats.hits == 0
+
+        result = draw('"Qzx Billy"')
+        assert result["recordsFiltered"] == 1
+        assert result["data"][0]["address"] == "Qzx Billy Road"
+
+        result = draw("Qzx", start=1)
+        assert [row["name"] for row in result["data"]] == ["Qzx Billy"]
+        assert cache.stats.hits == 2
+
+    def test_read_replicas(self):
+        """ Draws go to the replicas in turn, except right after a write on
+            the primary in the same request
+        """
+        import time
+        import flask_restful as rest
+        from flask import Flask
+
+        replicas = []
+        for i, count in enumerate((3, 5)):
+            path = 'testreplica{}.db'.format(i)
+            if os.path.isfile(path):
+                os.unlink(path)
+            engine = create_engine('sqlite:///{}'.format(path))
+            Base.metadata.create_all(engine)
+            session = sessionmaker(bind=engine)()
+            session.add_all([User(full_name="replica user") for _ in range(count)])
+            session.commit()
+            session.close()
+            replicas.append(engine)
+
+        app = Flask('test_replicas')
+        Resource, path, endpoint = get_resource(rest.Resource, User, self.session,
+                                                basepath='/api/', read_sessions=replicas,
+                                                staleness=5)
+        params = self.make_params_str(columns=('id', 'full_name'))
+
+        seen = []
+        for _ in range(3):
+            with app.test_request_context('/api/users?%s' % params):
+                seen.append(Resource().get()["recordsTotal"])
+        assert seen == [3, 5, 3]
+
+        with app.test_request_context('/api/users?%s' % params):
+            self.session.add(User(full_name="fresh"))
+            self.session.flush()
+            assert Resource().get()["recordsTotal"] == 11
+        self.session.rollback()
+
+        # a replica may lag behind the versions: draws on one only get an
+        # ETag once staleness has passed since the last commit to their
+        # tables, and never without a staleness
+        def etag(Resource):
+            with app.test_request_context('/api/users?%s' % params):
+                response = Resource().get()
+            return response[2]["ETag"] if isinstance(response, tuple) else None
+
+        Tagged = get_resource(rest.Resource, User, self.session, basepath='/api/', read_sessions=replicas,
+                              staleness=0.2, etags=True)[0]
+        Untagged = get_resource(rest.Resource, User, self.session, basepath='/api/', read_sessions=replicas,
+                                etags=True)[0]
+        assert etag(Tagged) is not None and etag(Untagged) is None
+        self.session.add(User(full_name="lagging"))
+        self.session.commit()
+        assert etag(Tagged) is None
+        time.sleep(0.25)
+        assert etag(Tagged) is not None
+
+        for i in range(2):
+            os.unlink('testreplica{}.db'.format(i))
+
+    def test_time_budget(self):
+        """ Statements are cancelled by the database once the budget of the
+            draw is spent
+        """
+        import time
+        from flask_datatables.budget import TimeBudget, BudgetExceeded
+
+        slow = ("WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c "
+                "WHERE x < 100000000) SELECT count(*) FROM c")
+        started = time.time()
+        try:
+            with TimeBudget(0.05).limit(self.session):
+                self.session.execute(slow).scalar()
+            assert False, "statement was not interrupted"
+        except BudgetExceeded:
+            pass
+        assert time.time() - started < 5
+        # the session is still usable afterwards
+        assert self.session.query(User).count() == 10
+
+        req = self.make_params(columns=("id",), order=[{"column": 0, "dir": "asc"}])
+        table = DataTable(req, User, self.session.query(User), ["id"], time_budget=5)
+        assert table.json()["recordsFiltered"] == 10
+        table = DataTable(req, User, self.session.query(User), ["id"], time_budget=-1)
+        assert "error" in table.json()
+
+    def test_count_cap(self):
+        """ Filtered counts stop at count_cap + 1 rows """
+        from flask_datatables.caching import QueryPlanCache
+
+        req = self.make_params(columns=("id",), order=[{"column": 0, "dir": "asc"}], length=3)
+        for cache in (None, QueryPlanCache()):
+            table = DataTable(req, User, self.session.query(User), ["id"],
+                              session=self.session, plan_cache=cache, count_cap=4)
+            result = table.json()
+            assert result["recordsFiltered"] == 4
+            assert result["recordsFilteredCapped"] is True
+            assert len(result["data"]) == 3
+
+            table = DataTable(req, User, self.session.query(User), ["id"],
+                              session=self.session, plan_cache=cache, count_cap=10)
+            result = table.json()
+            assert result["recordsFiltered"] == 10
+            assert "recordsFilteredCapped" not in result
+
+    def test_total_count_strategies(self):
+        """ recordsTotal can be exact, cached or estimated from statistics """
+        from flask_datatables.counting import get_total_counter
+
+        exact = get_total_counter("exact")
+        assert exact(self.session, User) == (10, True)
+
+        cached = get_total_counter("cached")
+        assert cached(self.session, User) == (10, True)
+        self.session.add(User(full_name="new"))
+        self.session.commit()
+        assert cached(self.session, User) == (10, False)
+
+        estimated = get_total_counter("estimated")
+        # no statistics yet: falls back to an exact count
+        assert estimated(self.session, User) == (11, True)
+        self.session.execute("ANALYZE")
+        assert estimated(self.session, User) == (11, False)
+
+        req = self.make_params(columns=("id",), order=[{"column": 0, "dir": "asc"}])
+        table = DataTable(req, User, self.session.query(User), ["id"], 11, total_exact=False)
+        assert table.json()["recordsTotalExact"] is False
+
+    def test_single_flight(self):
+        """ Concurrent identical draws share a single computation """
+        import threading
+        import time
+        from flask_datatables import request_signature
+        from flask_datatables.caching import SingleFlight
+
+        assert request_signature(self.make_params()) == \
+            request_signature(dict(self.make_params(), draw="7"))
+        assert request_signature(self.make_params()) != \
+            request_signature(self.make_params(start=10))
+
+        flights = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        calls, results = [], []
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return {"draw": 1}
+
+        def worker():
+            results.append(flights.do("users", compute))
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        assert len(calls) == 1
+        assert sorted(shared for result, shared in results) == [False, True, True, True]
+        # the key is released once done
+        assert flights.do("users", lambda: {"draw": 2}) == ({"draw": 2}, False)
+
+    def test_join_pruning(self):
+        """ Only relationships that are searched or ordered on get joined,
+            the others are loaded for the page's rows
+        """
+        user, addr = self.make_user("Silly Billy", "Silly Billy Road")
+        self.session.add(user)
+        self.session.commit()
+        columns = ["id", ("name", "full_name"), ("address", "address.description")]
+
+        req = self.make_params(order=[{"column": 0, "dir": "desc"}])
+        table = DataTable(req, User, self.session.query(User), columns)
+        plan = table.get_plan(None, table.get_column_searches(), table.get_ordering())
+        assert plan.joins == ()
+        assert plan.loads == ("address",)
+        result = table.json()
+        assert result["data"][0]["address"] == "Silly Billy Road"
+
+        req = self.make_params(order=[{"column": 0, "dir": "desc"}])
+        req["columns"][2]["search"]["value"] = "Billy Road"
+        table = DataTable(req, User, self.session.query(User), columns)
+        plan = table.get_plan(None, table.get_column_searches(), table.get_ordering())
+        assert plan.joins == ("address",)
+        assert plan.column_search == ("address",)
+        result = table.json()
+        assert result["recordsFiltered"] == 1
+        assert result["data"][0]["name"] == "Silly Billy"
+
+    def test_to_many_search(self):
+        """ Searching and ordering on a to-many relationship uses EXISTS and
+            subqueries, so each user is still one row
+        """
+        user, addr = self.make_user("Tagged Tom", "Tag Street")
+        user.tags = [Tag(name="zqred"), Tag(name="zqreddish"), Tag(name="blue")]
+        self.session.add(user)
+        self.session.commit()
+        columns = ["id", ("name", "full_name"), ("tags", "tags.name")]
+
+        req = self.make_params(search={"value": "zqred"}, columns=("id", "name", "tags"))
+        table = DataTable(req, User, self.session.query(User), columns)
+        plan = table.get_plan("zqred", [], table.get_ordering())
+        assert plan.joins == ()
+        result = table.json()
+        assert result["recordsFiltered"] == 1
+        assert len(result["data"]) == 1
+        assert sorted(result["data"][0]["tags"]) == ["blue", "zqred", "zqreddish"]
+
+        req = self.make_params(order=[{"column": 2, "dir": "desc"}], columns=("id", "name", "tags"))
+        table = DataTable(req, User, self.session.query(User), columns)
+        result = table.json()
+        assert result["recordsFiltered"] == 11
+        assert result["data"][0]["name"] == "Tagged Tom"
+
+    def test_match_modes(self):
+        """ Search values are escaped, and columns can match exactly or by prefix
+        """
+        for name in ("Qzx 100% Pure", "Qzx 1000 Pure", "Qzx_Under", "QzxAUnder"):
+            self.session.add(self.make_user(name, "Mode Street")[0])
+        self.session.commit()
+        columns = ["id", ("name", "full_name")]
+
+        def names(search, **kwargs):
+            req = self.make_params(search={"value": search}, columns=("id", "name"))
+            table = DataTable(req, User, self.session.query(User), columns, **kwargs)
+            return sorted(row["name"] for row in table.json()["data"])
+
+        assert names("100%") == ["Qzx 100% Pure"]
+        assert names("Qzx_") == ["Qzx_Under"]
+        assert names("Pure", match_modes={"name": "prefix"}) == []
+        assert names('"qzx 10"', match_modes={"name": "iprefix"}) == ["Qzx 100% Pure", "Qzx 1000 Pure"]
+        assert names("qzxaunder", default_match="iexact") == ["QzxAUnder"]
+
+        try:
+            DataTable(self.make_params(), User, self.session.query(User), columns,
+                      match_modes={"name": "fuzzy"})
+            assert False, "unknown match mode accepted"
+        except ValueError:
+            pass
+
+        req = self.make_params(columns=("id", "name"))
+        table = DataTable(req, User, self.session.query(User), columns,
+                          match_modes={"name": "iprefix"}, default_match="exact")
+        indexes = dict((index.column, index) for index in table.required_indexes())
+        assert indexes["full_name"].statement == \
+            "CREATE INDEX ix_users_full_name_iprefix ON users (lower(full_name) text_pattern_ops)"
+        assert indexes["id"].method == "btree"
+
+        # columns that are not strings are searched exactly with their own
+        # type, not cast to text, and only indexed for exact searches
+        user = self.session.query(User).filter_by(full_name="QzxAUnder").one()
+        assert names(str(user.id), default_match="exact") == ["QzxAUnder"]
+        assert names(str(user.id), default_match="iexact") == ["QzxAUnder"]
+        assert names("%d.0" % user.id, default_match="exact") == []
+        from flask_datatables.matching import match_predicate
+        assert str(match_predicate("iexact", "value")(User.id)) == "users.id = :value_integer"
+
+        def created(search, mode):
+            req = self.make_params(columns=("id", "created"), length=100)
+            req["columns"][1]["search"]["value"] = search
+            table = DataTable(req, User, self.session.query(User), ["id", ("created", "created_at")],
+                              match_modes={"created": mode})
+            return [row["id"] for row in table.json()["data"]]
+
+        assert created(user.created_at.isoformat(), "exact") == [user.id]
+        assert created(user.created_at.isoformat(), "iexact") == [user.id]
+        assert created("yesterday", "exact") == []
+        assert user.id in created(user.created_at.isoformat()[:10], "prefix")
+
+        indexes = required_indexes(User, {"created_at": "exact", "id": "prefix"})
+        assert [(index.column, index.definition) for index in indexes] == [("created_at", "created_at")]
+
+    def test_smart_search(self):
+        """ Every term of a global search must match, each in any column;
+            terms matching a term pattern only search that column
+        """
+        user, addr = self.make_user("Qzx Rackmaster", "rack12 Sjcway")
+        user2, addr2 = self.make_user("Qzx Sjcway", "rack13 Lane")
+        self.session.add_all((user, user2))
+        self.session.commit()
+        columns = ["id", ("name", "full_name"), ("address", "address.description")]
+
+        def draw(value, **kwargs):
+            req = self.make_params(search={"value": value})
+            table = DataTable(req, User, self.session.query(User), columns, **kwargs)
+            return table, table.json()
+
+        table, result = draw("sjcway rack12")
+        assert [row["name"] for row in result["data"]] == ["Qzx Rackmaster"]
+        table, result = draw("sjcway rack12", smart_search=False)
+        assert result["recordsFiltered"] == 0
+
+        # a word is never compared to the numeric id column
+        plan = table.get_plan("Qzx", [], [])
+        assert plan.search == (("name", "address"),)
+
+        table, result = draw("rack Sjcway", term_patterns={"address": r"rack\d*"})
+        assert table.get_plan("rack Sjcway", [], []).search == (("address",), ("name", "address"))
+        assert [row["name"] for row in result["data"]] == ["Qzx Rackmaster", "Qzx Sjcway"]
+
+    def test_regex_search(self):
+        """ Regex searches run in the database; bad patterns are an error """
+        from sqlalchemy.dialects import postgresql
+        from flask_datatables.matching import regex_predicate
+
+        for name, address in (("Qzx Rex", "Regex Road 7"), ("Qzx Rob", "Regex Road 12"), ("Qzx Rexa", "Elm")):
+            self.session.add(self.make_user(name, address)[0])
+        self.session.commit()
+        columns = ["id", ("name", "full_name"), ("address", "address.description")]
+
+        def draw(value, column_search=None):
+            req = self.make_params(search={"value": value, "regex": "true"})
+            if column_search:
+                req["columns"][2]["search"] = {"value": column_search, "regex": "true"}
+            table = DataTable(req, User, self.session.query(User), columns)
+            return table.json()
+
+        result = draw("^Qzx (Rex|Rob)$")
+        assert [row["name"] for row in result["data"]] == ["Qzx Rex", "Qzx Rob"]
+        result = draw("^Qzx", column_search="Road [0-9]{2}$")
+        assert [row["name"] for row in result["data"]] == ["Qzx Rob"]
+
+        assert "error" in draw("(Qzx")
+        assert "error" in draw("(a*)*b")
+        assert "error" in draw("(?P<name>Qzx)")
+
+        # a pattern the database's own engine rejects is an error too
+        check_regex = DataTable.__dict__["check_regex"]
+        DataTable.check_regex = staticmethod(lambda pattern: pattern)
+        try:
+            assert draw("(Qzx")["error"].startswith("Invalid regular expression")
+        finally:
+            DataTable.check_regex = check_regex
+        assert self.session.query(User).count() == 13
+
+        from sqlalchemy.exc import DBAPIError
+        from flask_datatables.matching import is_regex_error
+
+        class PostgresError(Exception):
+            pgcode = "2201B"
+
+        assert is_regex_error(DBAPIError("SELECT", {}, PostgresError("invalid regular expression")))
+        assert is_regex_error(DBAPIError("SELECT", {}, Exception(3688, "Syntax error in regular expression")))
+        assert not is_regex_error(DBAPIError("SELECT", {}, Exception(1064, "You have an error")))
+
+        criterion = regex_predicate("pattern")(User.full_name)
+        assert "users.full_name ~ %(pattern)s" == str(criterion.compile(dialect=postgresql.dialect()))
+
+    def test_etags(self):
+        """ Unchanged draws are answered with 304 without querying; writes
+            to a table the draw reads change its ETag
+        """
+        import flask_restful as rest
+        from flask import Flask
+
+        app = Flask('test_etags')
+        api = rest.Api(app)
+        Resource, path, endpoint = get_resource(rest.Resource, User, self.session,
+                                                basepath='/api/', etags=True)
+        api.add_resource(Resource, path, endpoint=endpoint)
+        client = app.test_client()
+        params = self.make_params_str(columns=('id', 'full_name', 'address__description'))
+
+        response = client.get('/api/users?%s' % params)
+        assert response.status_code == 200
+        etag = response.headers["ETag"]
+
+        response = client.get('/api/users?%s' % params.replace("draw=1", "draw=2"),
+                              headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.headers["ETag"] == etag
+
+        # errors are not tagged
+        response = client.get('/api/users?%s' % params.replace("start=0", "start=abc"))
+        assert "error" in response.get_json() and "ETag" not in response.headers
+
+        # another page is another response
+        response = client.get('/api/users?%s' % self.make_params_str(
+            start=10, columns=('id', 'full_name', 'address__description')), headers={"If-None-Match": etag})
+        assert response.status_code == 200
+
+        # so is any write to a table the draw reads
+        self.session.query(Address).first().description = "Etag Lane"
+        self.session.commit()
+        response = client.get('/api/users?%s' % params, headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+        etag = response.headers["ETag"]
+
+        # but only once committed: a draw between the flush and the commit
+        # reads the old rows elsewhere, a rollback changes nothing
+        self.session.query(Address).first().description = "Etag Road"
+        self.session.flush()
+        assert client.get('/api/users?%s' % params, headers={"If-None-Match": etag}).status_code == 304
+        self.session.rollback()
+        assert client.get('/api/users?%s' % params, headers={"If-None-Match": etag}).status_code == 304
+        self.session.query(Address).first().description = "Etag Road"
+        self.session.flush()
+        self.session.commit()
+        assert client.get('/api/users?%s' % params, headers={"If-None-Match": etag}).status_code == 200
+
+        # tables read by computed columns count too
+        from sqlalchemy import func, select
+        tag_count = select([func.count(Tag.id)]).where(Tag.user_id == User.id).as_scalar()
+        Resource, path, endpoint = get_resource(rest.Resource, User, self.session, basepath='/computed/',
+                                                etags=True, computed={"tag_count": tag_count})
+        api.add_resource(Resource, path, endpoint=endpoint)
+        params = self.make_params_str(columns=('id', 'tag_count'))
+        etag = client.get('/computed/users?%s' % params).headers["ETag"]
+        self.session.add(Tag(name="etag", user_id=1))
+        self.session.commit()
+        assert client.get('/computed/users?%s' % params, headers={"If-None-Match": etag}).status_code == 200
+
+    def test_prefetch(self):
+        """ The page after each draw is computed in the background and the
+            next draw is served from it
+        """
+        import time
+        import flask_restful as rest
+        from flask import Flask
+        from flask_datatables.prefetch import Prefetcher
+
+        try:
+            get_resource(rest.Resource, User, self.session, prefetch=True)
+            assert False, "prefetch accepted a plain session"
+        except ValueError:
+            pass
+
+        app = Flask('test_prefetch')
+        prefetcher = Prefetcher(workers=1, size=4)
+        Resource, path, endpoint = get_resource(rest.Resource, User, self.session, basepath='/api/',
+                                                read_sessions=sessionmaker(bind=self.session.get_bind()),
+                                                staleness=5, prefetch=prefetcher)
+
+        def draw(start, draw):
+            params = self.make_params_str(start=start, length=4, columns=('id', 'full_name'))
+            with app.test_request_context('/api/users?%s' % params.replace("draw=1", "draw=%d" % draw)):
+                return Resource().get()
+
+        def wait_for(results):
+            for _ in range(50):
+                if len(prefetcher.results) == results:
+                    return
+                time.sleep(0.05)
+
+        first = draw(0, 1)
+        wait_for(1)
+        second = draw(4, 2)
+        assert prefetcher.stats.hits == 1
+        assert second["draw"] == 2
+        assert len(second["data"]) == 4
+        assert not set(row["id"] for row in first["data"]) & set(row["id"] for row in second["data"])
+
+        # the last page has no page after it
+        wait_for(1)
+        draw(8, 3)
+        assert prefetcher.stats.hits == 2
+        assert len(prefetcher.results) == 0
+
+        # a page prefetched before a committed write is not served
+        draw(0, 4)
+        wait_for(1)
+        user = self.session.query(User).get(second["data"][0]["id"])
+        user.full_name += " Jr"  # keeps its place in the name ordering
+        self.session.commit()
+        third = draw(4, 5)
+        assert prefetcher.stats.hits == 2
+        assert third["data"][0]["full_name"] == user.full_name
+        prefetcher.shutdown()
+
+    def test_pk_cache(self):
+        """ Later pages of a filter and ordering are fetched by primary key;
+            a committed write invalidates the key list
+        """
+        from flask_datatables.caching import PrimaryKeyCache
+        from flask_datatables.versioning import TableVersions
+
+        for i in range(5):
+            self.session.add(self.make_user("Qzx Pager %d" % i, "Page Road %d" % i)[0])
+        self.session.commit()
+        versions = TableVersions()
+        versions.watch(self.session)
+        cache = PrimaryKeyCache(versions)
+        columns = ["id", ("name", "full_name"), ("address", "address.description")]
+
+        def draw(start, search="Qzx Pager"):
+            req = self.make_params(search={"value": search}, start=start, length=2,
+                                   order=[{"column": 1, "dir": "desc"}])
+            table = DataTable(req, User, self.session.query(User), columns, pk_cache=cache)
+            return table.json()
+
+        result = draw(0)
+        assert result["recordsFiltered"] == 5
+        assert [row["name"] for row in result["data"]] == ["Qzx Pager 4", "Qzx Pager 3"]
+        assert cache.stats.misses == 1
+        result = draw(4)
+        assert [row["name"] for row in result["data"]] == ["Qzx Pager 0"]
+        assert result["data"][0]["address"] == "Page Road 0"
+        assert cache.stats.hits == 1
+        assert draw(0, search='"Qzx Pager 1"')["recordsFiltered"] == 1
+        assert cache.stats.misses == 2
+
+        self.session.add(self.make_user("Qzx Pager 5", "Page Road 5")[0])
+        self.session.commit()
+        result = draw(0)
+        assert result["recordsFiltered"] == 6
+        assert result["data"][0]["name"] == "Qzx Pager 5"
+        assert cache.stats.misses == 3
+
+        # too many keys to keep: the keys are read once, later draws
+        # page with OFFSET straight away
+        cache.max_rows = 3
+        table = DataTable(self.make_params(search={"value": "Qzx Pager"}, length=2), User,
+                          self.session.query(User), columns, pk_cache=cache)
+        plan = table.get_plan("Qzx Pager", [], [])
+        for _ in range(2):
+            assert table.cached_keys(plan, table.plan_params(plan, "Qzx Pager", []), self.session, None) is None
+        assert cache.stats.misses == 4 and cache.stats.hits == 2
+        assert draw(2)["recordsFiltered"] == 6
+
+        # count_cap bounds the keys read; past it the count is capped as
+        # without the cache
+        from flask_datatables.budget import TimeBudget
+        cache = PrimaryKeyCache(versions)
+        req = self.make_params(search={"value": "Qzx Pager"}, length=2)
+        for cap, filtered in ((4, 4), (10, 6)):
+            for _ in range(2):
+                result = DataTable(req, User, self.session.query(User), columns, pk_cache=cache,
+                                   count_cap=cap).json()
+                assert result["recordsFiltered"] == filtered and len(result["data"]) == 2
+                assert result.get("recordsFilteredCapped", False) is (cap == 4)
+        assert cache.stats.misses == 2 and cache.stats.hits == 2
+
+        # keys that cannot be read in time are a miss, and the page is still
+        # served with OFFSET within the budget
+        table = DataTable(req, User, self.session.query(User), columns, pk_cache=cache)
+        plan = table.get_plan("Qzx Pager", [], table.get_ordering())
+        params = table.plan_params(plan, "Qzx Pager", [])
+        assert table.cached_keys(plan, params, self.session, TimeBudget(-1)) is None
+        result = DataTable(req, User, self.session.query(User), columns, pk_cache=cache,
+                           time_budget=5).json()
+        assert result["recordsFiltered"] == 6 and len(result["data"]) == 2
+        assert cache.stats.misses == 3 and cache.stats.hits == 3
+
+    def test_columnar(self):
+        """ Draws answered from the in-memory copy match the SQL ones, and
+            committed writes show up in it
+        """
+        import pytest
+        pytest.importorskip("numpy")
+        from flask_datatables.columnar import ColumnarTable
+
+        user, addr = self.make_user("Qzx Column", "Qzx Array Road")
+        user.tags = [Tag(name="Qzxtag"), Tag(name="zz")]
+        self.session.add_all([user, self.make_user("Qzx Vector", "Scalar Street")[0]])
+        self.session.commit()
+        columns = ["id", ("name", "full_name"), ("address", "address.description"), ("tags", "tags.name")]
+        columnar = ColumnarTable(User, ["id", "full_name", "address.description", "tags.name"],
+                                 self.session.get_bind())
+        columnar.watch(self.session)
+
+        def draw(table_columnar, **kwargs):
+            req = self.make_params(columns=("id", "name", "address", "tags"), **kwargs)
+            table = DataTable(req, User, self.session.query(User), columns, columnar=table_columnar)
+            result = table.json()
+            for row in result["data"]:
+                row["tags"] = sorted(row["tags"])
+            return result
+
+        for kwargs in ({}, {"search": {"value": "Qzx"}}, {"search": {"value": "Qzx Road"}},
+                       {"search": {"value": "Qzxtag"}}, {"search": {"value": "^Qzx V", "regex": "true"}},
+                       {"order": [{"column": 2, "dir": "desc"}, {"column": 0, "dir": "asc"}]},
+                       {"order": [{"column": 3, "dir": "desc"}]}, {"start": 5, "length": 4}):
+            expected = draw(None, **kwargs)
+            assert draw(columnar, **kwargs) == expected, kwargs
+
+        # exact searches compare the ids as integers in memory too
+        req = self.make_params(columns=("id", "name", "address", "tags"), search={"value": str(user.id)})
+        for match in ("exact", "iexact"):
+            assert [DataTable(req, User, self.session.query(User), columns, columnar=table_columnar,
+                              default_match=match).json()["recordsFiltered"]
+                    for table_columnar in (None, columnar)] == [1, 1]
+
+        # the table has 12 rows in memory; a commit reloads the changed one
+        assert columnar.snapshot().size == 12
+        assert draw(columnar, search={"value": "Qzx Vector"})["recordsFiltered"] == 1
+        self.session.query(User).filter_by(full_name="Qzx Vector").one().full_name = "Qzx Tensor"
+        self.session.commit()
+        assert draw(columnar, search={"value": "Qzx Vector"})["recordsFiltered"] == 0
+        result = draw(columnar, search={"value": "Tensor"})
+        assert result["recordsTotal"] == 12 and result["recordsFiltered"] == 1
+
+    def test_warm_up(self):
+        """ warm_up runs one draw per ordering plus a search, baking their
+            plans so the first real draw reuses one
+        """
+        import flask_restful as rest
+        from flask import Flask
+
+        app = Flask('test_warm_up')
+        Resource, path, endpoint = get_resource(rest.Resource, User, self.session, basepath='/api/')
+        assert Resource.warm_up() == 4  # id, full_name, created_at and a search
+        assert Resource.plan_cache.stats.misses == 4
+        assert Resource.warm_up(columns=["id", "full_name", "address__description"], search="") == 3
+
+        params = self.make_params_str(columns=('id', 'full_name', 'created_at'))
+        with app.test_request_context('/api/users?%s' % params):
+            assert Resource().get()["recordsTotal"] == 10
+        assert Resource.plan_cache.stats.hits == 1
+
+    def test_facets(self):
+        """ Facets count the distinct values of columns among the filtered
+            rows, are truncated to the limit and cached by filter
+        """
+        import flask_restful as rest
+        from flask import Flask
+
+        for i, street in enumerate(("Qzx Elm", "Qzx Elm", "Qzx Elm", "Qzx Oak", "Qzx Oak", "Qzx Ash")):
+            user, addr = self.make_user("Qzx Facet %d" % i, street)
+            user.tags = [Tag(name="qzxhot"), Tag(name="qzxnew" if i % 2 else "qzxold")]
+            self.session.add(user)
+        self.session.commit()
+
+        app = Flask('test_facets')
+        Resource, path, endpoint = get_resource(rest.Resource, User, self.session, basepath='/api/',
+                                                facet_limit=2, facet_max_limit=4)
+        params = self.make_params_str(search={"value": "Qzx"}, columns=('id', 'full_name'))
+
+        def facets(query):
+            with app.test_request_context('/api/users?%s&%s' % (params, query)):
+                return Resource().get()
+
+        result = facets("facets=address__description,tags__name")
+        assert result["facets"]["address__description"] == [
+            {"value": "Qzx Elm", "count": 3}, {"value": "Qzx Oak", "count": 2}]
+        assert result["facetsTruncated"] == {"address__description": True, "tags__name": True}
+        assert result["facets"]["tags__name"] == [
+            {"value": "qzxhot", "count": 6}, {"value": "qzxnew", "count": 3}]
+
+        result = facets("facets[0]=address__description&facets_limit=5")
+        assert len(result["facets"]["address__description"]) == 3
+        assert not result["facetsTruncated"]["address__description"]
+        assert Resource.facet_cache.stats.misses == 2
+
+        # facets_limit must be a positive integer and is lowered to the maximum
+        for limit in ("abc", "0", "-3"):
+            assert facets("facets=tags__name&facets_limit=%s" % limit)["error"] == \
+                "Parameter facets_limit is invalid"
+        result = facets("facets=tags__name&facets_limit=100000000")
+        assert len(result["facets"]["tags__name"]) == 3
+        req = self.make_params()
+        req["facets_limit"] = "100000000"
+        assert DataTable(req, User, self.session.query(User), ["id"]).facet_limit(2, 4) == 4
+
+        facets("facets=address__description,tags__name")
+        assert Resource.facet_cache.stats.hits == 1
+        assert "error" in facets("facets=nope")
+        # relationships and other attributes are not columns
+        for name in ("address", "metadata", "tags", "address__user", "nope__description"):
+            assert facets("facets=%s" % name)["error"] == "Cannot facet %s: column not found" % name
+
+    def test_batch_data(self):
+        """ Batch data callables are called once per page and give the same
+            DT_RowData as per row ones
+        """
+        calls = []
+
+        def street(instances):
+            calls.append(len(instances))
+            return dict((user.id, user.address.description) for user in instances)
+
+        def tagged(keys):
+            calls.append(len(keys))
+            return dict((user_id, "tagged") for user_id in keys if user_id % 2)
+
+        columns = ["id", ("name", "full_name")]
+        req = self.make_params(columns=("id", "name"), length=5)
+        table = DataTable(req, User, self.session.query(User), columns)
+        table.add_data(link=lambda user: "/users/%d" % user.id)
+        table.add_batch_data(street=street)
+        table.add_batch_data(by_key=True, tagged=tagged)
+        result = table.json()
+
+        assert calls == [5, 5]
+        for row in result["data"]:
+            user = self.session.query(User).get(row["id"])
+            assert row["DT_RowData"] == {
+                "link": "/users/%d" % user.id,
+                "street": user.address.description,
+                "tagged": "tagged" if user.id % 2 else None,
+            }
+
+        # the columnar engine serves data by primary key
+        try:
+            from flask_datatables.columnar import ColumnarTable
+            import numpy  # noqa
+        except ImportError:
+            return
+        columnar = ColumnarTable(User, ["id", "full_name"], self.session.get_bind())
+        table = DataTable(req, User, self.session.query(User), columns, columnar=columnar)
+        table.add_batch_data(by_key=True, tagged=tagged)
+        assert table.json()["data"] == [
+            dict(row, DT_RowData={"tagged": row["DT_RowData"]["tagged"]}) for row in result["data"]]
+        assert columnar.snapshot().size
+
+    def test_computed_columns(self):
+        """ Computed columns are selected with the page and can be searched
+            and ordered by, with or without cached plans and keys
+        """
+        from sqlalchemy import func, literal
+        from flask_datatables.caching import PrimaryKeyCache, QueryPlanCache
+        from flask_datatables.versioning import TableVersions
+
+        self.session.add(self.make_user("Qzx Longest Computed Name Of All", "Qzx Street")[0])
+        self.session.commit()
+        computed = {"label": literal("Qzx-") + User.full_name, "name_length": func.length(User.full_name)}
+        columns = ["id", ("name", "full_name"), "label", ("name_length", "name_length", lambda n: n * 10)]
+        caches = ({}, {"plan_cache": QueryPlanCache()}, {"pk_cache": PrimaryKeyCache(TableVersions())})
+        for kwargs in caches + caches:
+            req = self.make_params(columns=("id", "name", "label", "name_length"),
+                                   order=[{"column": 3, "dir": "desc"}], length=3)
+            table = DataTable(req, User, self.session.query(User), columns, session=self.session,
+                              computed=computed, **kwargs)
+            result = table.json()
+            assert "error" not in result, result
+            assert result["recordsFiltered"] == 11
+            assert [row["label"] for row in result["data"]] == \
+                ["Qzx-" + row["name"] for row in result["data"]]
+            assert result["data"][0]["name"] == "Qzx Longest Computed Name Of All"
+            assert result["data"][0]["name_length"] == 320
+            lengths = [row["name_length"] for row in result["data"]]
+            assert lengths == sorted(lengths, reverse=True)
+
+            req = self.make_params(columns=("id", "name", "label", "name_length"),
+                                   search={"value": "Qzx-Qzx"})
+            table = DataTable(req, User, self.session.query(User), columns, session=self.session,
+                              computed=computed, **kwargs)
+            result = table.json()
+            assert [row["name"] for row in result["data"]] == ["Qzx Longest Computed Name Of All"]
+
+    def test_aggregate_columns(self):
+        """ count, max... paths through to-many relationships are computed
+            in SQL and can be ordered and searched
+        """
+        for name, tags in (("Qzx None", []), ("Qzx One", ["b"]), ("Qzx Three", ["a", "qzxz", "c"])):
+            user = self.make_user(name, "Qzx Street")[0]
+            user.tags = [Tag(name=tag) for tag in tags]
+            self.session.add(user)
+        self.session.commit()
+
+        columns = [("name", "full_name"), ("tags__count", "tags.count"), ("tags__max__name", "tags.max.name")]
+        req = self.make_params(columns=("name", "tags__count", "tags__max__name"),
+                               order=[{"column": 1, "dir": "desc"}], length=3)
+        table = DataTable(req, User, self.session.query(User), columns)
+        assert set(table.computed) == {"tags.count", "tags.max.name"}
+        result = table.json()
+        assert result["recordsFiltered"] == 13
+        assert result["data"][:2] == [
+            {"name": "Qzx Three", "tags__count": 3, "tags__max__name": "qzxz"},
+            {"name": "Qzx One", "tags__count": 1, "tags__max__name": "b"},
+        ]
+
+        req = self.make_params(columns=("name", "tags__count", "tags__max__name"), search={"value": "qzxz"})
+        result = DataTable(req, User, self.session.query(User), columns).json()
+        assert [row["name"] for row in result["data"]] == ["Qzx Three"]
+
+        # address is a to-one relationship, so this is a plain column path
+        table = DataTable(req, User, self.session.query(User), [("n", "address.count")])
+        assert not table.computed
+
+    def test_export(self):
+        """ Exports have every filtered row in key order, whether ranges are
+            read by worker processes or not, and can be served by resources
+        """
+        import csv
+        import flask_restful as rest
+        from flask import Flask
+        from flask_datatables.export import Exporter
+
+        for i in range(7):
+            self.session.add(self.make_user("Qzx Export %d" % i, "Qzx Export Street")[0])
+        self.session.commit()
+        columns = ["id", ("name", "full_name"), ("address__description", "address.description")]
+        expected = [[str(user.id), user.full_name, user.address.description]
+                    for user in self.session.query(User).order_by(User.id)]
+
+        def export(exporter, fmt, **kwargs):
+            req = self.make_params(columns=("id", "name", "address__description"), **kwargs)
+            return "".join(exporter.export(DataTable(req, User, self.session.query(User), columns), fmt))
+
+        for exporter in (Exporter(workers=0, chunk_size=3), Exporter(workers=2, chunk_size=3)):
+            rows = list(csv.reader(export(exporter, "csv").splitlines()))
+            assert rows == [["id", "name", "address__description"]] + expected
+            lines = export(exporter, "ndjson", search={"value": '"Qzx Export"'}).splitlines()
+            assert [json.loads(line)["name"] for line in lines] == ["Qzx Export %d" % i for i in range(7)]
+
+        # ranges hold chunk_size filtered keys, whatever the gaps between them
+        ids = [user.id for user in self.session.query(User).filter(User.full_name.like("Qzx Export %"))
+               .order_by(User.id)]
+        self.session.query(User).filter_by(id=ids[1]).delete()
+        self.session.commit()
+        query = self.session.query(User).filter(User.full_name.like("Qzx Export %")).order_by(User.full_name)
+        assert Exporter(chunk_size=3).key_bounds(query, User.id) == [ids[0], ids[4], ids[6] + 1]
+        assert Exporter().key_bounds(query.filter(User.id < 0), User.id) == []
+
+        app = Flask('test_export')
+        Resource, path, endpoint = get_resource(rest.Resource, User, self.session, basepath='/api/',
+                                                export=Exporter(workers=0, chunk_size=4))
+        params = self.make_params_str(columns=("id", "full_name"))
+        with app.test_request_context('/api/users?%s&export=csv' % params):
+            response = Resource().get()
+            assert response.mimetype == "text/csv"
+            assert len(response.get_data(as_text=True).splitlines()) == 17
+        with app.test_request_context('/api/users?%s&export=xml' % params):
+            assert "error" in Resource().get()
+
+    def test_row_and_byte_limits(self):
+        """ max_rows and max_bytes cut pages short and say so, with rows
+            fetched a chunk at a time
+        """
+        import flask_datatables
+        from flask_datatables.caching import PrimaryKeyCache, QueryPlanCache
+        from flask_datatables.versioning import TableVersions
+        from sqlalchemy import event
+
+        columns = ["id", ("name", "full_name")]
+        calls = []
+
+        def draw(length, **kwargs):
+            req = self.make_params(columns=("id", "name"), length=length)
+            table = DataTable(req, User, self.session.query(User), columns, session=self.session, **kwargs)
+            table.add_batch_data(by_key=True, seen=lambda keys: calls.append(len(keys)) or {})
+            return table.json()
+
+        fetch_chunk = flask_datatables.FETCH_CHUNK
+        flask_datatables.FETCH_CHUNK = 3
+        try:
+            for cache in ({}, {"plan_cache": QueryPlanCache()},
+                          {"pk_cache": PrimaryKeyCache(TableVersions())}):
+                del calls[:]
+                result = draw(-1, max_rows=4, **cache)
+                assert len(result["data"]) == 4 and result["recordsFiltered"] == 10
+                assert result["dataTruncated"] and result["dataTruncatedBy"] == "max_rows"
+                assert calls == [3, 1]
+
+                result = draw(-1, **cache)
+                assert len(result["data"]) == 10 and "dataTruncated" not in result
+
+                # a short page is not truncated
+                result = draw(3, max_rows=4, **cache)
+                assert len(result["data"]) == 3 and "dataTruncated" not in result
+
+                # rows past the chunk max_bytes ends in are not read
+                row_bytes = len(json.dumps(result["data"][0])) + 1
+                del calls[:]
+                fetched = []
+                on_execute = lambda conn, cursor, statement, parameters, context, many: \
+                    fetched.append(len(parameters)) if "IN (" in statement else None
+                event.listen(self.session.get_bind(), "before_cursor_execute", on_execute)
+                try:
+                    result = draw(10, max_bytes=row_bytes * 2 + 1, **cache)
+                finally:
+                    event.remove(self.session.get_bind(), "before_cursor_execute", on_execute)
+                assert 1 <= len(result["data"]) <= 3
+                assert result["dataTruncatedBy"] == "max_bytes"
+                assert calls == [3]
+                # the key cache reads the rows of the first chunk of keys only
+                assert fetched == ([3] if "pk_cache" in cache else [])
+        finally:
+            flask_datatables.FETCH_CHUNK = fetch_chunk
+
+    def test_loadtest(self):
+        """ Recorded draws have their search values masked and can be
+            replayed concurrently with per endpoint latencies and statements
+        """
+        import flask_restful as rest
+        from flask import Flask
+        from flask_datatables.loadtest import TrafficRecorder, load_traffic, replay, sanitize_query
+
+        assert sanitize_query("search%5Bvalue%5D=%22Jane+Doe%22+42&_=123&length=10") == \
+            sanitize_query("search%5Bvalue%5D=%22Jane+Doe%22+42&length=10")
+        masked = sanitize_query("search%5Bvalue%5D=%22Jane+Doe%22+42&length=10")
+        assert "Jane" not in masked and "length=10" in masked
+
+        # the values the filters of a restless search compare to are masked
+        from flask_datatables.loadtest import FILTER_ARG, mask_json
+        from urllib.parse import parse_qsl, urlencode
+        search = {"filters": [{"or": [{"name": "full_name", "op": "like", "val": "%Jane Doe%"},
+                                      {"name": "id", "op": "in", "val": [12, 7]}]}]}
+        masked = dict(parse_qsl(sanitize_query(urlencode({FILTER_ARG: json.dumps(search)}))))
+        masked = json.loads(masked[FILTER_ARG])
+        like, ids = masked["filters"][0]["or"]
+        assert like["name"] == "full_name" and like["op"] == "like"
+        assert like["val"] == mask_json("%Jane Doe%") and "Jane" not in like["val"]
+        assert like["val"].startswith("%") and like["val"].endswith("%")
+        assert ids["val"] == mask_json([12, 7]) and all(isinstance(i, int) for i in ids["val"])
+        assert "Jane" not in sanitize_query("q=%7Bnot+json+Jane")
+
+        path = "loadtest.ndjson"
+        if os.path.isfile(path):
+            os.unlink(path)
+        recorder = TrafficRecorder(path)
+        app = Flask('test_loadtest')
+        api = rest.Api(app)
+        Resource, url, endpoint = get_resource(rest.Resource, User, self.session, basepath='/api/',
+                                               read_sessions=sessionmaker(bind=self.session.get_bind()),
+                                               recorder=recorder)
+        api.add_resource(Resource, url, endpoint=endpoint)
+        client = app.test_client()
+        for start in (0, 4):
+            params = self.make_params_str(start=start, length=4, search={"value": "Qzx"},
+                                          columns=('id', 'full_name'))
+            assert client.get('/api/users?%s&_=1' % params).status_code == 200
+        # the file is written in the background
+        assert recorder._writer.daemon and len(recorder.requests) == 2
+        try:
+            recorder.flush()
+            requests = load_traffic(path)
+            assert requests == recorder.requests and len(requests) == 2
+            assert all(request.path == "/api/users" and "Qzx" not in request.query for request in requests)
+
+            # the replayed draws are recorded too
+            report = replay(app, requests, concurrency=2, repeat=3).as_dict()
+            recorder.flush()
+            assert len(load_traffic(path)) == 8
+        finally:
+            os.unlink(path)
+        stats = report["/api/users"]
+        assert stats["requests"] == 6 and stats["errors"] == 0
+        assert stats["p50"] <= stats["p95"] <= stats["p99"]
+        assert stats["statements"] >= 6 and stats["throughput"] > 0